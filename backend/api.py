@@ -4,34 +4,77 @@ Returns:
     Base 64 images
 """
 
+import functools
 import numpy as np
-import qiskit
-from qiskit_textbook.widgets import plot_bloch_vector_spherical
-from qiskit.visualization import plot_bloch_multivector
 
 
 import visualizer
 
+# Coordinates are rounded to this many decimals before rendering, so slider
+# drags that differ by less than a pixel reuse the same cached image
+PRECISION = 3
+IMAGE_CACHE_SIZE = 1024
 
-def show_radial(coords):
-    plt = plot_bloch_vector_spherical(coords)
-    return visualizer._export_png(plt)
 
+def _quantize(coords):
+    return tuple(round(float(coord), PRECISION) + 0.0 for coord in coords)  # + 0.0 drops -0.0
 
-def show_multivector(coords):
-    qc = qiskit.QuantumCircuit(1)
+
+def _get_state(coords):
+    # Single qbit state for (real |0>, imag |0>, real |1>, imag |1>), computed directly
+    import qiskit.quantum_info
 
     non_normalized = np.array([complex(*coords[0:2]), complex(*coords[2:4])])
     # Normalize each component
-    part_normalized = np.nan_to_num(
-        non_normalized / np.abs(non_normalized))  # nan -> 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        part_normalized = np.nan_to_num(
+            non_normalized / np.abs(non_normalized))  # nan -> 0
 
     # Normalize all components
-    initial_state = part_normalized / np.linalg.norm(part_normalized)
+    return qiskit.quantum_info.Statevector(part_normalized / np.linalg.norm(part_normalized))
+
+
+@functools.lru_cache(maxsize=IMAGE_CACHE_SIZE)
+def _render_radial(coords):
+    # qiskit, qiskit_textbook and matplotlib are only imported by the first render (see warm_up)
+    from qiskit_textbook.widgets import plot_bloch_vector_spherical
+
+    with visualizer.render_lock:
+        plt = plot_bloch_vector_spherical(list(coords))
+        return visualizer._export_png(plt)
+
+
+@functools.lru_cache(maxsize=IMAGE_CACHE_SIZE)
+def _render_multivector(coords):
+    from qiskit.visualization import plot_bloch_multivector
+
+    state = _get_state(coords)
+    with visualizer.render_lock:
+        plt = plot_bloch_multivector(state)
+        return visualizer._export_png(plt)
+
+
+def show_radial(coords):
+    return _render_radial(_quantize(coords))
+
+
+def show_multivector(coords):
+    return _render_multivector(_quantize(coords))
+
+
+def show_radials(coords_list):
+    # Batch of show_radial, repeated coordinates are only rendered once
+    return [show_radial(coords) for coords in coords_list]
+
+
+def show_multivectors(coords_list):
+    # Batch of show_multivector, repeated coordinates are only rendered once
+    return [show_multivector(coords) for coords in coords_list]
 
-    qc.initialize(initial_state, 0)
 
-    backend = qiskit.Aer.get_backend('statevector_simulator')
-    out = qiskit.execute(qc, backend).result().get_statevector()
-    plt = plot_bloch_multivector(out)
-    return visualizer._export_png(plt)
+def warm_up():
+    # Preload the plotting dependencies, which otherwise load on the first request
+    import qiskit.quantum_info
+    import qiskit.visualization
+    import qiskit_textbook.widgets
+    visualizer.warm_up()
@@ -2,36 +2,87 @@
 
 Required for the physics simulations on the web demo.
 """
-from flask import Flask, request, render_template, json
+from flask import Flask, Response, g, request, render_template, json
 import flask_cors
+import os
+import time
 import traceback
 
 import api
+import jobs
 import qml
-
-flask_cors.CORS(app)
+import metrics  # on the path once qml is imported
 
 
 app = Flask(__name__,
             static_folder='../web/dist',
             static_url_path='')
+flask_cors.CORS(app)
+
+qml_jobs = jobs.JobQueue()
+
+
+def warm_up():
+    """
+    Heavy dependencies (qiskit, matplotlib) are imported on the first request
+    that needs them. Preload them instead, e.g. in the parent process before a
+    server like gunicorn --preload forks its workers. Runs on import when
+    QST_PRELOAD=1 is set.
+    """
+
+    qml.warm_up()
+    api.warm_up()
+
+
+if os.environ.get('QST_PRELOAD', '') not in ('', '0'):
+    warm_up()
+
+
+@app.before_request
+def start_timer():
+    if metrics.enabled:
+        g.start_time = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    # Time and count every request by endpoint when metrics are enabled (QST_METRICS=1)
+    if metrics.enabled and 'start_time' in g:
+        metrics.count(f'app.requests.{request.endpoint}')
+        metrics.record(f'app.{request.endpoint}', time.perf_counter() - g.start_time)
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Counters and per phase timers of this process
+    return json.dumps(metrics.snapshot())
 
 @app.route('/')
 def main_page():
     return app.send_static_file('index.html')
 
 
+def _get_multivector_coords(recv):
+    return [float(recv[i]) for i in ('r0', 'i0', 'r1', 'i1')]
+
+
+def _get_radial_coords(recv):
+    return recv['radialX'], recv['radialY'], 1
+
+
 @app.route('/multivector', methods=['POST'])
 def get_multivector():
     # Deprecated
+    # A list of coordinates is rendered as a batch and answered with {'imgs': [...]}
     recv = request.get_json(force=True)
 
-    coords = []
-    for i in ('r0', 'i0', 'r1', 'i1'):
-        coords.append(float(recv[i]))
+    if isinstance(recv, list):
+        imgs = api.show_multivectors([_get_multivector_coords(item) for item in recv])
+        return json.dumps({'imgs': [img.decode() for img in imgs]})
 
     output = {}
-    output['img'] = api.show_multivector(coords).decode()
+    output['img'] = api.show_multivector(_get_multivector_coords(recv)).decode()
 
     return json.dumps(output)
 
@@ -39,12 +90,15 @@ def get_multivector():
 @app.route('/radial', methods=['POST'])
 def get_radial():
     # Deprecated
+    # A list of coordinates is rendered as a batch and answered with {'imgs': [...]}
     recv = request.get_json(force=True)
 
-    coords = recv['radialX'], recv['radialY'], 1
+    if isinstance(recv, list):
+        imgs = api.show_radials([_get_radial_coords(item) for item in recv])
+        return json.dumps({'imgs': [img.decode() for img in imgs]})
 
     output = {}
-    output['img'] = api.show_radial(coords).decode()
+    output['img'] = api.show_radial(_get_radial_coords(recv)).decode()
 
     return json.dumps(output)
 
@@ -54,6 +108,12 @@ def get_qml():
     # Quantum machine learning endpoint
     recv = request.get_json(force=True)
 
+    try:
+        qml.validate(recv)
+    except (KeyError, TypeError, ValueError):
+        traceback.print_exc()
+        return json.dumps({'error': 'invalid parameters'}), 400
+
     try:
         output = qml.show_phis(recv)
     except Exception:
@@ -65,5 +125,48 @@ def get_qml():
         return json.dumps(output)
 
 
+@app.route('/qml/jobs', methods=['POST'])
+def submit_qml_job():
+    # Start a QML fit in the background, its iterations are streamed by /qml/jobs/<job_id>/stream
+    recv = request.get_json(force=True)
+
+    try:
+        job = qml_jobs.submit(recv)
+    except jobs.QueueFull as error:
+        return json.dumps({'error': str(error)}), 503
+    except (KeyError, TypeError, ValueError):
+        traceback.print_exc()
+        return json.dumps({'error': 'invalid parameters'}), 400
+
+    return json.dumps(job.summary()), 202
+
+
+@app.route('/qml/jobs/<job_id>', methods=['GET'])
+def get_qml_job(job_id):
+    job = qml_jobs.get(job_id)
+    if job is None:
+        return json.dumps({'error': 'unknown job'}), 404
+    return json.dumps(job.summary())
+
+
+@app.route('/qml/jobs/<job_id>', methods=['DELETE'])
+def cancel_qml_job(job_id):
+    job = qml_jobs.cancel(job_id)
+    if job is None:
+        return json.dumps({'error': 'unknown job'}), 404
+    return json.dumps(job.summary())
+
+
+@app.route('/qml/jobs/<job_id>/stream', methods=['GET'])
+def stream_qml_job(job_id):
+    # Server-sent events, one 'iteration' event per optimizer iteration
+    job = qml_jobs.get(job_id)
+    if job is None:
+        return json.dumps({'error': 'unknown job'}), 404
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(job.events(), mimetype='text/event-stream', headers=headers)
+
+
 if __name__ == '__main__':
     app.run()
@@ -0,0 +1,157 @@
+"""Asynchronous QML jobs
+
+Runs QML fits on a bounded pool of worker threads and streams each
+iteration to the client as server-sent events while the fit is running.
+"""
+
+import collections
+import concurrent.futures
+import json
+import os
+import threading
+import traceback
+import uuid
+
+import qml
+import metrics  # on the path once qml is imported
+
+MAX_WORKERS = int(os.environ.get('QML_WORKERS', 2))  # fits running at the same time
+MAX_PENDING = 16  # queued and running jobs accepted before new submissions are refused
+MAX_JOBS = 64  # finished jobs kept around for late stream requests
+
+ACTIVE = ('queued', 'running')
+
+
+class QueueFull(RuntimeError):
+    pass
+
+
+def _event(name, data):
+    # Format a server-sent event
+    return f'event: {name}\ndata: {json.dumps(data)}\n\n'
+
+
+class Job:
+    """
+    A single fit. Frames (one dict per optimizer iteration, see qml.stream_phis)
+    are appended by the worker thread and read by any number of streams.
+    """
+
+    def __init__(self, kwargs):
+        self.id = uuid.uuid4().hex
+        self.kwargs = kwargs
+        self.status = 'queued'
+        self.frames = []
+        self.max_mag = None
+        self.error = None
+        self.stop_event = threading.Event()
+        self._changed = threading.Condition()
+
+    def _add_frame(self, frame):
+        with self._changed:
+            self.frames.append(frame)
+            self._changed.notify_all()
+
+    def _set_status(self, status, error=None):
+        with self._changed:
+            self.status = status
+            self.error = error
+            self._changed.notify_all()
+
+    def run(self):
+        if self.stop_event.is_set():  # cancelled while queued
+            self._set_status('cancelled')
+            return
+
+        self._set_status('running')
+        try:
+            output = qml.stream_phis(self.kwargs, self._add_frame, stop_event=self.stop_event)
+        except Exception as error:
+            print('qml job error', self.id)
+            traceback.print_exc()
+            self._set_status('error', str(error))
+        else:
+            if output is not None:
+                self.max_mag = output['maxMag']
+            self._set_status('cancelled' if output is None else 'done')
+        metrics.count(f'jobs.{self.status}')
+
+    def cancel(self):
+        # A queued job never starts, a running one stops after its current iteration
+        self.stop_event.set()
+
+    def summary(self):
+        return {'job_id': self.id, 'status': self.status, 'iterations': len(self.frames), 'error': self.error}
+
+    def events(self, keep_alive=15):
+        """
+        Generator of server-sent events: an 'iteration' event per frame (the
+        frames produced so far are sent first), then a final 'done', 'cancelled'
+        or 'error' event. A comment is sent every keep_alive seconds while
+        waiting so proxies do not close the connection.
+
+        :param keep_alive: float, seconds between keep-alive comments
+        """
+
+        sent = 0
+        while True:
+            with self._changed:
+                if sent == len(self.frames) and self.status in ACTIVE:
+                    self._changed.wait(keep_alive)
+                frames = self.frames[sent:]
+                status = self.status  # no frames are added once the status is final
+
+            for frame in frames:
+                yield _event('iteration', frame)
+            sent += len(frames)
+
+            if status not in ACTIVE:
+                yield _event(status, {'maxMag': self.max_mag, 'error': self.error})
+                return
+            if not frames:
+                yield ': keep-alive\n\n'
+
+
+class JobQueue:
+    """
+    Bounded pool of worker threads running Jobs. The optimization is cancelled
+    through the stop_event of its copt.OptimizerSession.
+    """
+
+    def __init__(self, max_workers=MAX_WORKERS, max_pending=MAX_PENDING, max_jobs=MAX_JOBS):
+        self.max_pending = max_pending
+        self.max_jobs = max_jobs
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix='qml-job')
+        self._jobs = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, kwargs):
+        """
+        :param kwargs: dict, request parameters (circ_depth, num_qbits, optional seed, init and format)
+        :return: Job, the queued job
+        """
+
+        qml.validate(kwargs)  # reject bad parameters before queueing
+        with self._lock:
+            if sum(job.status in ACTIVE for job in self._jobs.values()) >= self.max_pending:
+                raise QueueFull('too many QML jobs pending, try again later')
+
+            job = Job(kwargs)
+            self._jobs[job.id] = job
+            finished = [job_id for job_id, old in self._jobs.items() if old.status not in ACTIVE]
+            for job_id in finished[:max(0, len(self._jobs) - self.max_jobs)]:
+                del self._jobs[job_id]
+
+        metrics.count('jobs.submitted')
+        self._executor.submit(job.run)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is not None:
+            job.cancel()
+        return job
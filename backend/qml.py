@@ -3,54 +3,229 @@
 Allows user to run QML with varying parameters.
 """
 
+import argparse
+import base64
+import collections
+import contextlib
+import functools
+import json
+import multiprocessing as mp
 import numpy as np
 import os
 import sys
+import threading
+import zlib
 
 backend = os.path.dirname(os.path.abspath(__file__))
 qml_approach = os.path.join(os.path.dirname(backend), 'qml_approach')
+wrapped_qml_method = os.path.join(os.path.dirname(backend), 'wrapped_qml_method')
 sys.path.insert(1, qml_approach)
+sys.path.insert(1, wrapped_qml_method)
 
-import qpu
 import qml_main
 import copt
+import metrics
+import precision
+import warm_start
 
+# number of random thetas in the warm start bank of each circuit shape, see warm_start.WarmStart.random
+WARM_START_BANK_SIZE = 10_000
+WARM_START_BANKS = 8  # circuit shapes whose bank is kept in memory (10 MB each at 6 qbits)
 
-def _get_phis(circ_depth, num_qbits):
-    print('get_phis', 'circ_depth =', circ_depth, ' num_qbits =', num_qbits)
+
+# show_phis results kept in memory, and optionally persisted as json files in QML_CACHE_DIR
+CACHE_SIZE = 256
+CACHE_DIR = os.environ.get('QML_CACHE_DIR')
+CACHE_DISK_SIZE = int(os.environ.get('QML_CACHE_DISK_SIZE', 4096))  # max number of json files in CACHE_DIR
+
+# initializations of theta accepted in requests, and the seeds of the target states
+INIT_METHODS = ('zeros', 'warm')
+MAX_SEED = 2**32 - 1
+
+# response formats of show_phis, 'compact' packs the phis as a base64 float32 array (see compact_output)
+PAYLOAD_FORMATS = ('json', 'compact')
+
+# parameter grid exposed by the web demo (web/src/components/qml-demo.js), see precompute
+DEMO_CIRC_DEPTHS = range(1, 11)
+DEMO_NUM_QBITS = range(1, 7)
+
+# largest circuits accepted in requests, the demo grid unless configured otherwise
+MAX_CIRC_DEPTH = int(os.environ.get('QML_MAX_CIRC_DEPTH', max(DEMO_CIRC_DEPTHS)))
+MAX_NUM_QBITS = int(os.environ.get('QML_MAX_NUM_QBITS', max(DEMO_NUM_QBITS)))
+
+
+class ResultCache:
+    """
+    Thread safe, bounded LRU cache of show_phis results. The results are
+    deterministic for a given (circ_depth, num_qbits, seed, init, precision), so a repeated
+    request is answered without optimizing again. Concurrent misses on the same
+    key wait for the first computation instead of starting their own. If a
+    directory is given, results are also written there as json and survive a
+    restart of the server. The directory is bounded too, the least recently
+    used files are deleted once it holds more than disk_size results.
+    """
+
+    def __init__(self, maxsize=CACHE_SIZE, directory=None, disk_size=CACHE_DISK_SIZE):
+        """
+        :param maxsize: int, maximum number of results held in memory
+        :param directory: str, optional, directory the results are persisted in
+        :param disk_size: int, maximum number of results kept in directory
+        """
+
+        self.maxsize = maxsize
+        self.directory = directory
+        self.disk_size = disk_size
+        self._results = collections.OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        circ_depth, num_qbits, seed, init, precision_name = key
+        return os.path.join(self.directory, f'd{circ_depth}_q{num_qbits}_s{seed}_{init}_{precision_name}.json')
+
+    def _load(self, key):
+        if self.directory is None or not os.path.exists(self._path(key)):
+            return None
+        with open(self._path(key), 'r') as file:
+            result = json.load(file)
+        os.utime(self._path(key))  # the modification time orders the files for eviction
+        return result
+
+    def _save(self, key, result):
+        if self.directory is None:
+            return
+        temp_path = self._path(key) + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(result, file)
+        os.replace(temp_path, self._path(key))  # readers never see a partially written file
+        self._evict_files()
+
+    def _evict_files(self):
+        # Delete the least recently used json files beyond disk_size
+        paths = [entry.path for entry in os.scandir(self.directory) if entry.name.endswith('.json')]
+        if len(paths) <= self.disk_size:
+            return
+        paths.sort(key=lambda path: os.stat(path).st_mtime)
+        for path in paths[:len(paths) - self.disk_size]:
+            with contextlib.suppress(FileNotFoundError):  # already evicted by another thread
+                os.remove(path)
+
+    def _insert(self, key, result):
+        # must hold self._lock
+        self._results[key] = result
+        self._results.move_to_end(key)
+        while len(self._results) > self.maxsize:
+            self._results.popitem(last=False)
+
+    def peek(self, key):
+        """
+        :param key: tuple, (circ_depth, num_qbits, seed, init, precision)
+        :return: the cached result, or None on a miss (nothing is computed)
+        """
+
+        with self._lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+                return self._results[key]
+
+        result = self._load(key)
+        if result is not None:
+            with self._lock:
+                self._insert(key, result)
+        return result
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._results:
+                return True
+        return self.directory is not None and os.path.exists(self._path(key))
+
+    def put(self, key, result):
+        self._save(key, result)
+        with self._lock:
+            self._insert(key, result)
+
+    def get(self, key, compute):
+        """
+        :param key: tuple, (circ_depth, num_qbits, seed, init, precision)
+        :param compute: callable, computes the result on a miss
+        :return: the cached or freshly computed result
+        """
+
+        while True:
+            with self._lock:
+                if key in self._results:
+                    self._results.move_to_end(key)
+                    metrics.count('qml.cache_hits')
+                    return self._results[key]
+                done = self._in_flight.get(key)
+                if done is None:
+                    done = self._in_flight[key] = threading.Event()
+                    break
+            done.wait()  # another thread is computing this key, then look again
+
+        try:
+            result = self._load(key)
+            if result is None:
+                metrics.count('qml.cache_misses')
+                with metrics.timer('qml.compute_phis'):
+                    result = compute()
+                self._save(key, result)
+            with self._lock:
+                self._insert(key, result)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            done.set()
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+
+_cache = ResultCache(directory=CACHE_DIR)
+
+
+@functools.lru_cache(maxsize=WARM_START_BANKS)
+def _get_warm_start(circ_depth, num_qbits):
+    # Built once per process and circuit shape, seeded so cached results stay reproducible
+    return warm_start.WarmStart.random(circ_depth, num_qbits, size=WARM_START_BANK_SIZE, seed=qml_main.random_seed)
+
+
+def _get_phis(circ_depth, num_qbits, init='zeros', seed=qml_main.random_seed, on_iteration=None, stop_event=None):
+    print('get_phis', 'circ_depth =', circ_depth, ' num_qbits =', num_qbits, ' init =', init, ' seed =', seed)
 
     # randomly select a target state |psi>
-    psi = qml_main.generate_random_psi(num_qbits=num_qbits)
+    psi = qml_main.generate_random_psi(num_qbits=num_qbits, seed=seed)
     # initialize the parameters of our variational circuit
     initial_theta = qml_main.initialize_theta(
         circ_depth=circ_depth, num_qbits=num_qbits)
     # Final result
 
-    copt.reset()
-    results, optimizer_data = copt.optimize_theta_scp(initial_theta, psi)
-
-    # Get loss and fidelity
-    loss_series = []
-    fidelity_series = []
-    phis = []
+    # loss, fidelity and states are recorded as the optimizer produces each iterate
+    session = copt.OptimizerSession(psi, circ_depth, num_qbits, record_states=True, stop_event=stop_event,
+                                    on_iteration=on_iteration)
+    strategy = _get_warm_start(circ_depth, num_qbits) if init == 'warm' else None
+    results, optimizer_data = copt.optimize_theta_scp(initial_theta, psi, session=session, warm_start=strategy)
 
-    for optimizer in optimizer_data:
-        theta = np.reshape(optimizer, (circ_depth, num_qbits))
-        fidelity = copt.get_fidelity(theta, psi)
-        loss = copt.get_loss(fidelity)
+    loss_series = list(session.losses)
+    fidelity_series = list(session.fidelities)
+    from qiskit.quantum_info import Statevector  # heavy, imported on first use (see warm_up)
 
-        loss_series.append(loss)
-        fidelity_series.append(fidelity)
-        phis.append(qpu.get_state(theta))
+    phis = [Statevector(state) for state in session.states]
 
     return loss_series, fidelity_series, phis
 
 
-def _export_phi(phi):
+def _export_phi(phi, precision_name=None):
     result = phi.to_dict()
     for key, value in result.items():
-        # Drop surrounding brackets ( )
-        result[key] = [value.real, value.imag]
+        # Drop surrounding brackets ( ), in single precision the json carries float32 digits only
+        result[key] = [precision.to_precision(value.real, precision_name),
+                       precision.to_precision(value.imag, precision_name)]
 
     return result
 
@@ -60,18 +235,220 @@ def _get_max_mag(phi):
     return max(abs(num) for num in result.values())
 
 
-def show_phis(kwargs):
-    loss_series, fidelity_series, phis = _get_phis(**kwargs)
+def _get_key(kwargs):
+    # Validated request parameters, raises ValueError before anything is computed or cached
+    circ_depth, num_qbits = int(kwargs['circ_depth']), int(kwargs['num_qbits'])
+    if not 1 <= circ_depth <= MAX_CIRC_DEPTH:
+        raise ValueError(f'circ_depth {circ_depth} out of range, expected 1 to {MAX_CIRC_DEPTH}')
+    if not 1 <= num_qbits <= MAX_NUM_QBITS:
+        raise ValueError(f'num_qbits {num_qbits} out of range, expected 1 to {MAX_NUM_QBITS}')
+    seed = int(kwargs.get('seed', qml_main.random_seed))
+    if not 0 <= seed <= MAX_SEED:
+        raise ValueError(f'seed {seed} out of range, expected 0 to {MAX_SEED}')
+    init = kwargs.get('init', 'zeros')
+    if init not in INIT_METHODS:
+        raise ValueError(f'unknown init {init!r}, expected one of {INIT_METHODS}')
+    return circ_depth, num_qbits, seed, init, precision.precision  # payloads are rounded to the precision
+
+
+def _compute_phis(circ_depth, num_qbits, seed, init, precision_name, on_iteration=None, stop_event=None):
+    loss_series, fidelity_series, phis = _get_phis(circ_depth, num_qbits, init=init, seed=seed,
+                                                   on_iteration=on_iteration, stop_event=stop_event)
 
     serialized_phis = []
     for phi in phis:
-        serialized_phis.append(_export_phi(phi))
+        serialized_phis.append(_export_phi(phi, precision_name))
 
     output = {
-        'fidelity_series': fidelity_series,
-        'loss_series': loss_series,
-        'maxMag': _get_max_mag(phis[-1]),
+        'fidelity_series': [precision.to_precision(value, precision_name) for value in fidelity_series],
+        'loss_series': [precision.to_precision(value, precision_name) for value in loss_series],
+        'maxMag': precision.to_precision(_get_max_mag(phis[-1]), precision_name),
         'phis': serialized_phis,
     }
 
     return output
+
+
+def _phi_array(phis, num_qbits):
+    # Exported phis (dicts of basis label -> [real, imag], zero amplitudes omitted) -> (iterations, 2**n, 2)
+    array = np.zeros((len(phis), 2**num_qbits, 2), dtype=np.float32)
+    for i, phi in enumerate(phis):
+        for label, value in phi.items():
+            array[i, int(label, 2)] = value
+    return array
+
+
+def _encode_array(array, compress=False):
+    data = np.ascontiguousarray(array, dtype='<f4').tobytes()
+    if compress:
+        data = zlib.compress(data)
+    return base64.b64encode(data).decode('ascii')
+
+
+def compact_output(output, num_qbits, compress=False, delta=False):
+    """
+    Pack the phis of a show_phis output as a little endian float32 array of
+    shape (iterations, 2**num_qbits, 2), holding the (real, imag) part of every
+    amplitude, encoded as base64. Decoded by web/src/backend/parseComplex.js.
+
+    :param output: dict, show_phis output in the json format
+    :param num_qbits: int, number of qbits
+    :param compress: bool, zlib compress the array before encoding it
+    :param delta: bool, store each iteration as its difference from the previous one
+                  (compresses better, the client takes the cumulative sum)
+    :return: dict, same keys as output with phis replaced by the encoded array
+    """
+
+    phis = _phi_array(output['phis'], num_qbits)
+    if delta:
+        phis[1:] = np.diff(phis.astype(np.float64), axis=0)
+
+    compact = dict(output)
+    compact.update({
+        'format': 'compact',
+        'shape': list(phis.shape),
+        'dtype': 'float32',
+        'compression': 'zlib' if compress else None,
+        'delta': delta,
+        'phis': _encode_array(phis, compress=compress),
+    })
+    return compact
+
+
+def _get_format(kwargs):
+    payload_format = kwargs.get('format', 'json')
+    if payload_format not in PAYLOAD_FORMATS:
+        raise ValueError(f'unknown format {payload_format!r}, expected one of {PAYLOAD_FORMATS}')
+    return payload_format
+
+
+def validate(kwargs):
+    """
+    Check the request parameters of show_phis / stream_phis without computing anything
+    :param kwargs: dict, request parameters (circ_depth, num_qbits, optional seed, init and format)
+    :return: None, raises KeyError, TypeError or ValueError for invalid parameters
+    """
+
+    _get_key(kwargs)
+    _get_format(kwargs)
+
+
+def show_phis(kwargs):
+    # Repeated requests are served from the cache, only new parameters are optimized
+    key = _get_key(kwargs)
+    payload_format = _get_format(kwargs)
+    output = _cache.get(key, functools.partial(_compute_phis, *key))
+
+    if payload_format == 'compact':
+        return compact_output(output, key[1], compress=bool(kwargs.get('compress')),
+                              delta=bool(kwargs.get('delta')))
+    return output
+
+
+def _export_frame(loss, fidelity, phi, compact=False, precision_name=None):
+    # A single iteration of a run, as streamed by the job API (see jobs.py)
+    from qiskit.quantum_info import Statevector
+
+    phi = Statevector(phi)
+    if compact:  # base64 float32 array of shape (2**n, 2), like a single iteration of compact_output
+        exported = _encode_array(np.stack([phi.data.real, phi.data.imag], axis=-1))
+    else:
+        exported = _export_phi(phi, precision_name)
+    return {'loss': precision.to_precision(loss, precision_name),
+            'fidelity': precision.to_precision(fidelity, precision_name), 'phi': exported,
+            'maxMag': precision.to_precision(_get_max_mag(phi), precision_name)}
+
+
+def _iter_frames(output, num_qbits, compact=False, precision_name=None):
+    # Replay a finished show_phis output as frames
+    phis = _phi_array(output['phis'], num_qbits)
+    for loss, fidelity, phi, array in zip(output['loss_series'], output['fidelity_series'], output['phis'], phis):
+        max_mag = precision.to_precision(np.max(np.hypot(array[:, 0], array[:, 1])), precision_name)
+        exported = _encode_array(array) if compact else phi
+        yield {'loss': loss, 'fidelity': fidelity, 'phi': exported, 'maxMag': max_mag}
+
+
+def stream_phis(kwargs, on_frame, stop_event=None):
+    """
+    Same as show_phis, but on_frame is called with every iteration (loss, fidelity,
+    phi and maxMag) as soon as the optimizer produces it. A cached result is
+    replayed. The run stops at the next iteration once stop_event is set, a
+    cancelled run is not cached.
+
+    :param kwargs: dict, request parameters (circ_depth, num_qbits, optional seed, init and format)
+    :param on_frame: callable, called with the dict of each iteration
+    :param stop_event: threading.Event, optional, cancels the run once set
+    :return: dict, same output as show_phis, None if the run was cancelled
+    """
+
+    key = _get_key(kwargs)
+    compact = _get_format(kwargs) == 'compact'
+    output = _cache.peek(key)
+    if output is not None:
+        for frame in _iter_frames(output, key[1], compact=compact, precision_name=key[4]):
+            on_frame(frame)
+        return output
+
+    def on_iteration(iteration, loss, fidelity, phi):
+        on_frame(_export_frame(loss, fidelity, phi, compact=compact, precision_name=key[4]))
+
+    output = _compute_phis(*key, on_iteration=on_iteration, stop_event=stop_event)
+    if stop_event is not None and stop_event.is_set():
+        return None
+
+    _cache.put(key, output)
+    return output
+
+
+def warm_up():
+    # Preload qiskit, scipy.optimize and the simulation caches, see copt.warm_up
+    copt.warm_up(num_qbits=DEMO_NUM_QBITS)
+
+
+def _precompute_job(key):
+    return key, _compute_phis(*key)
+
+
+def precompute(circ_depths=DEMO_CIRC_DEPTHS, num_qbits=DEMO_NUM_QBITS, seeds=(qml_main.random_seed,),
+               init='zeros', processes=None):
+    """
+    Warm up the cache with every parameter combination of the demo grid, the
+    optimizations run in parallel. Set QML_CACHE_DIR (or pass --cache-dir) so
+    the results are persisted and picked up by the server.
+
+    :param circ_depths: iterable of ints, circuit depths
+    :param num_qbits: iterable of ints, numbers of qbits
+    :param seeds: iterable of ints, seeds of the target states
+    :param init: str, 'zeros' or 'warm', initialization of theta
+    :param processes: int, number of worker processes (os.cpu_count() if None)
+    :return: int, number of results computed (combinations already cached are skipped)
+    """
+
+    keys = [(int(circ_depth), int(qbits), int(seed), init, precision.precision)
+            for seed in seeds for qbits in num_qbits for circ_depth in circ_depths]
+    keys = [key for key in keys if key not in _cache]
+
+    with mp.Pool(processes) as pool:
+        for count, (key, output) in enumerate(pool.imap_unordered(_precompute_job, keys), start=1):
+            _cache.put(key, output)
+            print(f'precomputed {count}/{len(keys)}: circ_depth={key[0]} num_qbits={key[1]} seed={key[2]}')
+
+    return len(keys)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Precompute /qml results for the web demo parameter grid')
+    parser.add_argument('--cache-dir', default=CACHE_DIR or os.path.join(backend, 'qml_cache'))
+    parser.add_argument('--seeds', type=int, nargs='+', default=[qml_main.random_seed])
+    parser.add_argument('--init', choices=INIT_METHODS, default='zeros')
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args()
+
+    global _cache
+    _cache = ResultCache(directory=args.cache_dir)
+    precompute(seeds=args.seeds, init=args.init, processes=args.processes)
+    return
+
+
+if __name__ == '__main__':
+    main()
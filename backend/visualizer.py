@@ -1,6 +1,18 @@
 # Turn to base64
 import base64
 import io
+import threading
+
+# pyplot keeps global state, figures are built and rasterized one at a time
+render_lock = threading.Lock()
+
+
+def _pyplot():
+    # Matplotlib is only imported once the first image is rendered (see warm_up)
+    import matplotlib
+    matplotlib.use('Agg')  # render off screen, the server never shows a window
+    import matplotlib.pyplot as pyplot
+    return pyplot
 
 
 def _export_png(plt):
@@ -8,5 +20,10 @@ def _export_png(plt):
     pic_IObytes = io.BytesIO()
     plt.set_size_inches(3, 3)  # 300 x 300 px
     plt.savefig(pic_IObytes, format='png')
+    _pyplot().close(plt)  # free the figure, pyplot would otherwise keep every one of them alive
     pic_IObytes.seek(0)
     return base64.b64encode(pic_IObytes.read())
+
+
+def warm_up():
+    _pyplot()
@@ -0,0 +1,367 @@
+# performance benchmarks: simulation, gradient, optimization, data set I/O and the /qml endpoint
+import argparse
+import datetime
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+import numpy as np
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.join(root, 'qml_approach'))
+sys.path.insert(1, os.path.join(root, 'data_gen'))
+sys.path.insert(1, os.path.join(root, 'wrapped_qml_method'))
+sys.path.insert(1, os.path.join(root, 'backend'))
+
+import copt
+import data_io
+import generate_data
+import qpu
+
+QUBITS = (2, 4, 6, 8)
+DEPTHS = (2, 5, 10, 20)
+RESULTS_DIR = os.path.join(root, 'benchmarks', 'results')
+
+# cold import time target, heavy dependencies (qiskit, matplotlib, scipy.optimize) must load lazily
+STARTUP_TARGET_S = 1.0
+STARTUP_MODULES = {'qml_approach': ('qml_main', 'copt', 'tomography'), 'backend': ('app',)}
+HEAVY_MODULES = ('qiskit', 'matplotlib', 'scipy.optimize', 'tensorflow')
+OPTIONAL_MODULES = ('flask', 'flask_cors', 'tensorflow', 'qiskit_textbook')  # a suite needing them is skipped
+
+
+def _is_optional(name):
+    # True if name is (a submodule of) one of the OPTIONAL_MODULES
+    return name is not None and name.split('.')[0] in OPTIONAL_MODULES
+
+
+def _time_call(function, min_time=0.2, max_repeats=10_000):
+    """
+    Time function() by repeating it until min_time seconds have passed (like timeit.autorange)
+    :param function: callable without arguments
+    :param min_time: float, minimum total time measured
+    :param max_repeats: int, maximum number of calls
+    :return: float, mean seconds per call
+    """
+
+    function()  # warm up caches (cx permutations, imports)
+    repeats, start = 0, time.perf_counter()
+    while True:
+        function()
+        repeats += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or repeats >= max_repeats:
+            return elapsed / repeats
+
+
+def _random_theta(circ_depth, num_qbits, rng):
+    return rng.uniform(0, 2 * np.pi, (circ_depth, num_qbits))
+
+
+def _random_psi(num_qbits, rng):
+    return generate_data.random_states(1, num_qbits, rng=rng)[0]
+
+
+def bench_simulation(num_qbits, circ_depth, batch_size=64, qiskit=False, rng=None):
+    """
+    Circuit simulation throughput
+    :return: dict, evaluations per second of qpu.simulate_theta, batched qpu.simulate_thetas
+             and (if qiskit) qpu.construct_variational_circ + qpu.simulate_circ
+    """
+
+    rng = np.random.default_rng(rng)
+    theta = _random_theta(circ_depth, num_qbits, rng)
+    thetas = rng.uniform(0, 2 * np.pi, (batch_size, circ_depth, num_qbits))
+
+    result = {
+        'evals_per_s': 1 / _time_call(lambda: qpu.simulate_theta(theta)),
+        'batched_evals_per_s': batch_size / _time_call(lambda: qpu.simulate_thetas(thetas)),
+    }
+    if qiskit:
+        result['qiskit_evals_per_s'] = 1 / _time_call(
+            lambda: qpu.simulate_circ(qpu.construct_variational_circ(theta)), max_repeats=50)
+    return result
+
+
+def bench_gradient(num_qbits, circ_depth, rng=None):
+    """
+    Loss gradient time
+    :return: dict, seconds per copt.compute_loss_gradient call for each gradient method
+    """
+
+    rng = np.random.default_rng(rng)
+    theta_vector = np.ravel(_random_theta(circ_depth, num_qbits, rng))
+    psi = _random_psi(num_qbits, rng)
+
+    return {f'{method}_gradient_s': _time_call(
+                lambda: copt.compute_loss_gradient(theta_vector, psi, circ_depth, num_qbits, method))
+            for method in copt.GRADIENT_METHODS}
+
+
+def bench_optimization(num_qbits, circ_depth, num_targets=3, target_fidelity=0.99, maxiter=500, rng=None):
+    """
+    Time for optimize_theta_scp to reach target_fidelity from a random theta, over random targets
+    (starting from all zeros often stalls in a local minimum well below 0.99)
+    :return: dict, median time and iterations to the target (over the runs reaching it, None if
+             none did), fraction of targets reaching it, median run time and final fidelity
+    """
+
+    rng = np.random.default_rng(rng)
+    times, iterations, fidelities = [], [], []
+    for _ in range(num_targets):
+        psi = _random_psi(num_qbits, rng)
+        session = copt.OptimizerSession(psi, circ_depth, num_qbits, target_fidelity=target_fidelity)
+        copt.optimize_theta_scp(_random_theta(circ_depth, num_qbits, rng), psi, session=session, maxiter=maxiter)
+
+        times.append(session.wall_time)
+        iterations.append(session.iterations)
+        fidelities.append(session.fidelities[-1] if session.fidelities else 0.0)
+
+    reached = np.array(fidelities) >= target_fidelity
+    return {
+        'time_to_fidelity_s': float(np.median(np.array(times)[reached])) if reached.any() else None,
+        'iterations_to_fidelity': float(np.median(np.array(iterations)[reached])) if reached.any() else None,
+        'fraction_reached': float(np.mean(reached)),
+        'run_time_s': float(np.median(times)),
+        'final_fidelity': float(np.median(fidelities)),
+        'target_fidelity': target_fidelity,
+    }
+
+
+def bench_dataset(num_qbits, num_states=20_000, rng=None):
+    """
+    Data set load throughput, of the txt files (nn.open_files, needs tensorflow)
+    and of the binary format (data_io.open_dataset, read fully into memory)
+    :return: dict, MB/s of each format (size on disk / load time)
+    """
+
+    rng = np.random.default_rng(rng)
+    circ_depth = 8
+    psi = generate_data.random_states(num_states, num_qbits, rng=rng)
+    theta = rng.uniform(0, 2 * np.pi, (num_states, circ_depth, num_qbits))
+    result = {'num_states': num_states}
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench.qst')
+        data_io.write_dataset(path, psi, theta)
+        size = sum(os.path.getsize(os.path.join(path, name)) for name in (data_io.PSI_FILE, data_io.THETA_FILE))
+
+        def load_binary():
+            header, psi_data, theta_data = data_io.open_dataset(path)
+            return np.array(psi_data), np.array(theta_data)
+
+        result['binary_mb_per_s'] = size / 1e6 / _time_call(load_binary, max_repeats=20)
+
+        psi_file, theta_file = os.path.join(directory, 'psi.txt'), os.path.join(directory, 'theta.txt')
+        with open(psi_file, 'w') as file:  # same layout as generate_data.generate_psi_data_set
+            row_format = ','.join(['(%.17g%+.17gj)'] * 2**num_qbits) + '\n'
+            file.write((row_format * num_states) % tuple(psi.view(np.float64).ravel()))
+        np.savetxt(theta_file, np.reshape(theta, (num_states, -1)), delimiter=',', fmt='%.17g')
+        size = os.path.getsize(psi_file) + os.path.getsize(theta_file)
+
+        try:
+            import nn
+        except ModuleNotFoundError as error:
+            if not _is_optional(error.name):
+                raise
+            result['text_skipped'] = str(error)
+        else:
+            result['text_mb_per_s'] = size / 1e6 / _time_call(lambda: nn.open_files(psi_file, theta_file),
+                                                              max_repeats=3)
+    return result
+
+
+def bench_endpoint(num_qbits, circ_depth, num_requests=10):
+    """
+    Latency of the /qml endpoint through the Flask test client, for new
+    parameters (a different seed every request) and for cached repeats
+    :return: dict, p50/p90/p99 latencies in seconds
+    """
+
+    import app  # needs the backend dependencies (flask, qiskit_textbook)
+
+    if num_qbits > app.qml.MAX_NUM_QBITS or circ_depth > app.qml.MAX_CIRC_DEPTH:
+        return {'skipped': 'outside the /qml limits (QML_MAX_NUM_QBITS, QML_MAX_CIRC_DEPTH)'}
+
+    client = app.app.test_client()
+    latencies = {'uncached': [], 'cached': []}
+    for seed in range(num_requests):
+        request = {'circ_depth': circ_depth, 'num_qbits': num_qbits, 'seed': 1_000_000 + seed}
+        for kind in ('uncached', 'cached'):
+            start = time.perf_counter()
+            client.post('/qml', data=json.dumps(request))
+            latencies[kind].append(time.perf_counter() - start)
+
+    return {f'{kind}_p{q}_s': float(np.percentile(values, q))
+            for kind, values in latencies.items() for q in (50, 90, 99)}
+
+
+def bench_startup(directory, modules, repeats=3):
+    """
+    Cold start: time to import modules in a fresh interpreter (interpreter start up included)
+    :param directory: str, directory of the modules, relative to the repo root
+    :param modules: tuple of str, modules to import
+    :param repeats: int, number of fresh interpreters, the median is reported
+    :return: dict, median import time, whether it meets STARTUP_TARGET_S and the heavy modules loaded
+    """
+
+    code = (f'import sys, time, json; start = time.perf_counter(); import {", ".join(modules)}; '
+            f'print(json.dumps([time.perf_counter() - start, [name for name in {HEAVY_MODULES!r} '
+            f'if name in sys.modules]]))')
+
+    times, loaded = [], None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, '-c', code], cwd=os.path.join(root, directory),
+                                 capture_output=True, text=True)
+        if process.returncode != 0:
+            error = process.stderr.strip().splitlines()[-1]
+            missing = re.match(r"ModuleNotFoundError: No module named '([\w.]+)'", error)
+            if missing and _is_optional(missing.group(1)):
+                raise ModuleNotFoundError(error, name=missing.group(1))
+            raise RuntimeError(error)
+        times.append(time.perf_counter() - start)
+        import_time, loaded = json.loads(process.stdout.splitlines()[-1])
+
+    return {'startup_s': float(np.median(times)), 'meets_target': float(np.median(times)) <= STARTUP_TARGET_S,
+            'target_s': STARTUP_TARGET_S, 'heavy_modules_loaded': loaded}
+
+
+def _metadata():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=root, capture_output=True,
+                                text=True).stdout.strip()
+    except OSError:
+        commit = None
+
+    return {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def run(qubits=QUBITS, depths=DEPTHS, suites=('startup', 'simulation', 'gradient', 'optimization', 'dataset',
+                                               'endpoint'), qiskit=False, seed=1):
+    """
+    Run the benchmark suites over the grid of qubit counts and circuit depths
+    :param qubits: iterable of ints, numbers of qbits
+    :param depths: iterable of ints, circuit depths
+    :param suites: iterable of str, which benchmarks to run
+    :param qiskit: bool, also time the qiskit simulator (slow)
+    :param seed: int, seed of the random thetas and target states
+    :return: dict, metadata and a list of result records per suite
+    """
+
+    results = {'metadata': _metadata(), 'results': {suite: [] for suite in suites}, 'errors': 0}
+
+    def record(suite, params, function):
+        try:
+            values = function()
+        except ModuleNotFoundError as error:
+            if not _is_optional(error.name):  # a broken import is a failure, not a missing extra
+                traceback.print_exc()
+                values = {'error': str(error)}
+                results['errors'] += 1
+            else:
+                values = {'skipped': str(error)}
+        except Exception as error:
+            traceback.print_exc()
+            values = {'error': f'{type(error).__name__}: {error}'}
+            results['errors'] += 1
+        results['results'][suite].append({**params, **values})
+        print(suite, params, {key: round(value, 6) if isinstance(value, float) else value
+                              for key, value in values.items()})
+
+    if 'startup' in suites:
+        for directory, modules in STARTUP_MODULES.items():
+            record('startup', {'directory': directory}, lambda: bench_startup(directory, modules))
+
+    for num_qbits in qubits:
+        if 'dataset' in suites:
+            record('dataset', {'num_qbits': num_qbits}, lambda: bench_dataset(num_qbits, rng=seed))
+        for circ_depth in depths:
+            params = {'num_qbits': num_qbits, 'circ_depth': circ_depth}
+            if 'simulation' in suites:
+                record('simulation', params, lambda: bench_simulation(num_qbits, circ_depth, qiskit=qiskit, rng=seed))
+            if 'gradient' in suites:
+                record('gradient', params, lambda: bench_gradient(num_qbits, circ_depth, rng=seed))
+            if 'optimization' in suites:
+                record('optimization', params, lambda: bench_optimization(num_qbits, circ_depth, rng=seed))
+            if 'endpoint' in suites:
+                record('endpoint', params, lambda: bench_endpoint(num_qbits, circ_depth))
+
+    return results
+
+
+def compare(baseline, current, threshold=0.2):
+    """
+    Compare two result files, report metrics that got worse by more than threshold
+    :param baseline: dict, results of an earlier run
+    :param current: dict, results of this run
+    :param threshold: float, relative change counted as a regression
+    :return: list of str, one line per regression
+    """
+
+    regressions = []
+    for suite, records in current['results'].items():
+        old_records = baseline['results'].get(suite, [])
+        for record in records:
+            params = {key: record[key] for key in ('num_qbits', 'circ_depth', 'directory') if key in record}
+            old = next((old for old in old_records
+                        if all(old.get(key) == value for key, value in params.items())), None)
+            if old is None:
+                continue
+
+            for key, value in record.items():
+                if key in params or not isinstance(value, float) or not isinstance(old.get(key), float):
+                    continue
+                # throughputs (per_s) should not drop, times (_s) should not grow
+                change = (old[key] - value) / old[key] if 'per_s' in key else (value - old[key]) / old[key]
+                if key.endswith('_s') and change > threshold:
+                    regressions.append(f'{suite} {params} {key}: {old[key]:.6g} -> {value:.6g} ({change:+.0%})')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the performance benchmarks and save the results as json')
+    parser.add_argument('--qubits', type=int, nargs='+', default=QUBITS)
+    parser.add_argument('--depths', type=int, nargs='+', default=DEPTHS)
+    parser.add_argument('--suites', nargs='+', default=['startup', 'simulation', 'gradient', 'optimization',
+                                                        'dataset', 'endpoint'])
+    parser.add_argument('--qiskit', action='store_true', help='also time the qiskit simulator')
+    parser.add_argument('--output', default=None, help='results file (default: results/<timestamp>.json)')
+    parser.add_argument('--compare', default=None, help='results file of an earlier run to check against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='relative slow down counted as a regression')
+    args = parser.parse_args()
+
+    results = run(args.qubits, args.depths, args.suites, qiskit=args.qiskit)
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, results['metadata']['timestamp'].replace(':', '-') + '.json')
+    with open(output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print('results written to', output)
+
+    regressions = []
+    if args.compare is not None:
+        with open(args.compare, 'r') as file:
+            regressions = compare(json.load(file), results, threshold=args.threshold)
+        print('\n'.join(regressions) if regressions else 'no regressions')
+    if results['errors']:
+        print(f"{results['errors']} benchmark(s) failed")
+    sys.exit(1 if regressions or results['errors'] else 0)
+
+
+if __name__ == '__main__':
+    main()
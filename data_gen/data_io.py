@@ -0,0 +1,141 @@
+# Binary on-disk format for psi/theta data sets
+import json
+import os
+import numpy as np
+
+FORMAT_VERSION = 1
+HEADER_FILE = 'header.json'
+PSI_FILE = 'psi.npy'
+THETA_FILE = 'theta.npy'
+DTYPES = (np.complex128, np.complex64)  # double and single precision psi, theta uses the matching float
+
+
+def _read_header(path):
+    with open(os.path.join(path, HEADER_FILE), 'r') as file:
+        return json.load(file)
+
+
+def _write_header(path, header):
+    with open(os.path.join(path, HEADER_FILE), 'w') as file:
+        json.dump(header, file, indent=2)
+
+
+def _check_dtype(dtype):
+    dtype = np.dtype(dtype)
+    if dtype not in DTYPES:
+        raise ValueError(f'unsupported data set dtype {dtype}, expected one of {[np.dtype(d).name for d in DTYPES]}')
+    return dtype
+
+
+def create_dataset(path, num_states, num_qbits, circ_depth=None, dtype=np.complex128):
+    """
+    Create an empty data set on disk and return it as writable memory-mapped arrays.
+    A data set is a directory holding a header (header.json, records the number of
+    states, qbits, the circuit depth and the dtype), the quantum states psi.npy of shape
+    (num_states, 2**num_qbits) and, if circ_depth is given, the parameterizations
+    theta.npy of shape (num_states, circ_depth, num_qbits). Rows can be filled in
+    any order, which suits results arriving from a process pool. Single precision
+    (complex64 psi, float32 theta) halves the size of the data set.
+
+    :param path: str, directory of the data set (conventionally ending in .qst)
+    :param num_states: int, number of states in the data set
+    :param num_qbits: int, number of qbits in each state
+    :param circ_depth: int, depth of the variational circuit, None for a data set of states only
+    :param dtype: np.complex128 or np.complex64, dtype of psi (theta gets the matching float dtype)
+    :return: 2 np.memmap, psi and theta (None if circ_depth is None)
+    """
+
+    dtype = _check_dtype(dtype)
+    os.makedirs(path, exist_ok=True)
+    num_states, num_qbits = int(num_states), int(num_qbits)
+    circ_depth = None if circ_depth is None else int(circ_depth)
+    _write_header(path, {'format_version': FORMAT_VERSION, 'num_states': num_states,
+                         'num_qbits': num_qbits, 'circ_depth': circ_depth, 'dtype': dtype.name})
+
+    psi = np.lib.format.open_memmap(os.path.join(path, PSI_FILE), mode='w+', dtype=dtype,
+                                    shape=(num_states, 2**num_qbits))
+    theta = None
+    if circ_depth is not None:
+        theta = np.lib.format.open_memmap(os.path.join(path, THETA_FILE), mode='w+', dtype=np.finfo(dtype).dtype,
+                                          shape=(num_states, circ_depth, num_qbits))
+    return psi, theta
+
+
+def open_dataset(path, mode='r'):
+    """
+    Open a data set written by create_dataset / write_dataset. The arrays are
+    memory-mapped, so opening is instant and nothing is copied into RAM until
+    it is accessed.
+
+    :param path: str, directory of the data set
+    :param mode: str, 'r' for read only, 'r+' to modify the data set in place
+    :return: dict header, np.memmap psi and np.memmap theta (None if the data set has no thetas)
+    """
+
+    header = _read_header(path)
+    if header['format_version'] != FORMAT_VERSION:
+        raise ValueError(f"unsupported data set format version {header['format_version']}")
+
+    psi = np.load(os.path.join(path, PSI_FILE), mmap_mode=mode)
+    theta = None
+    if header['circ_depth'] is not None:
+        theta = np.load(os.path.join(path, THETA_FILE), mmap_mode=mode)
+    return header, psi, theta
+
+
+def write_dataset(path, psi, theta=None, dtype=np.complex128):
+    """
+    Write complete psi (and theta) arrays as a data set
+
+    :param path: str, directory of the data set
+    :param psi: np.array of shape (num_states, 2**num_qbits), the quantum states
+    :param theta: np.array of shape (num_states, circ_depth, num_qbits), optional, the parameterizations
+    :param dtype: np.complex128 or np.complex64, precision the data set is stored in
+    :return: None
+    """
+
+    num_states, dim = np.shape(psi)
+    num_qbits = int(np.log2(dim))
+    circ_depth = None if theta is None else np.shape(theta)[1]
+
+    psi_out, theta_out = create_dataset(path, num_states, num_qbits, circ_depth=circ_depth, dtype=dtype)
+    psi_out[:] = psi
+    psi_out.flush()
+    if theta is not None:
+        theta_out[:] = theta
+        theta_out.flush()
+    return
+
+
+def convert_text_dataset(psi_file, path, theta_file=None, dtype=np.complex128):
+    """
+    Convert a text data set (one comma separated line of complex coefficients
+    per state, and optionally one line of comma separated thetas per state)
+    into the binary data set format. The circuit depth is inferred from the
+    number of thetas per line.
+
+    :param psi_file: str, path to the txt file containing quantum state data
+    :param path: str, directory of the new data set
+    :param theta_file: str, optional, path to the txt file containing the parameterization data
+    :param dtype: np.complex128 or np.complex64, precision the data set is stored in
+    :return: None
+    """
+
+    psi = np.loadtxt(psi_file, dtype=np.complex128, delimiter=',', ndmin=2)  # parsed in double, rounded on write
+    theta = None
+    if theta_file is not None:
+        num_qbits = int(np.log2(psi.shape[1]))
+        theta = np.loadtxt(theta_file, dtype=np.float64, delimiter=',', ndmin=2)
+        theta = np.reshape(theta, (len(theta), -1, num_qbits))
+
+    write_dataset(path, psi, theta, dtype=dtype)
+    return
+
+
+def main():
+    # convert_text_dataset("3Qbit_psi_1k_newPsi.txt", "3Qbit_psi_1k.qst", theta_file="3Qbit_psi_1k_newTheta.txt")
+    return
+
+
+if __name__ == '__main__':
+    main()
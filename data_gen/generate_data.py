@@ -1,6 +1,12 @@
 # Main file for generating data
-from qiskit import *
 import numpy as np
+import os
+import sys
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'qml_approach'))
+
+import data_io
+import precision
 
 
 def random_state_gen(num_qbits, real_valued_state=False):
@@ -12,6 +18,8 @@ def random_state_gen(num_qbits, real_valued_state=False):
     :return: qiskit.quantum_info.Statevector object: an array of complex #s
     """
 
+    import qiskit.quantum_info  # heavy, only imported when a Statevector is needed
+
     dim = 2**num_qbits
 
     if real_valued_state:
@@ -38,6 +46,9 @@ def change_basis(psi, basis='z', random_seed=1):
     :return: unitary: a qiskit.quantum_info.Operator object
     """
 
+    import qiskit
+    import qiskit.quantum_info
+
     num_qbits = psi.num_qubits
     qbit_tuple = tuple(range(num_qbits))
     circ = qiskit.QuantumCircuit(num_qbits)
@@ -99,48 +110,217 @@ def measure_raw(state_vect, shots=1_000_000, random_seed=1):
     return results
 
 
-def generate_psi_data_set(file_name, shots=1000, num_qbits=3):
+def sample_outcomes(state_vect, shots, rng=None):
+    """
+    Make measurements along the z basis by sampling the outcome indices directly
+    from the probabilities, one small unsigned integer per shot.
+
+    :param state_vect: qiskit.quantum_info.Statevector object
+    :param shots: int, representing # of measurements
+    :param rng: np.random.Generator or int, optional, source of randomness
+    :return: np.array of shape (shots,), index of the measured basis state for each shot
+    """
+
+    rng = np.random.default_rng(rng)
+    probability_vec = state_vect.probabilities()
+    outcomes = rng.choice(len(probability_vec), size=shots, p=probability_vec / probability_vec.sum())
+    return outcomes.astype(np.min_scalar_type(len(probability_vec) - 1))
+
+
+def measure_counts(state_vect, shots=1_000_000, random_seed=1):
+    """
+    Make measurements along the z basis and only keep how often each outcome occurred
+
+    :param state_vect: qiskit.quantum_info.Statevector object
+    :param shots: int, representing # of measurements
+    :param random_seed: int, for setting the 'randomness'
+    :return: np.array of len 2**num_qbits, counts of each basis state
+    """
+
+    rng = np.random.default_rng(random_seed)
+    probability_vec = state_vect.probabilities()
+    return rng.multinomial(shots, probability_vec / probability_vec.sum())
+
+
+def measure_bases(psi, bases=('x', 'y', 'z'), shots=1_000_000, random_seed=1):
+    """
+    Measure a state in several bases, the input expected by the shot based
+    tomography in qml_approach/tomography.py
+
+    :param psi: qiskit.quantum_info.Statevector object
+    :param bases: list of str, 'x', 'y' or 'z' (see change_basis)
+    :param shots: int, # of measurements per basis
+    :param random_seed: int, for setting the 'randomness'
+    :return: np.array of shape (len(bases), 2**num_qbits), counts of each outcome in each basis
+    """
+
+    counts = []
+    for index, basis in enumerate(bases):
+        statevect, unitary = change_basis(psi, basis=basis)
+        counts.append(measure_counts(statevect, shots, random_seed=random_seed + index))
+
+    return np.array(counts)
+
+
+def outcome_bits(outcomes, num_qbits):
+    """
+    Expand measured outcome indices into raw measurements (one bit per qbit)
+
+    :param outcomes: np.array of shape (shots,), measured basis state indices
+    :param num_qbits: int, number of qbits
+    :return: np.array of uint8, shape (shots, num_qbits), same layout as measure_raw
+    """
+
+    bits = (np.asarray(outcomes)[:, np.newaxis] >> np.arange(num_qbits - 1, -1, -1)) & 1
+    return bits.astype(np.uint8)
+
+
+def pack_outcomes(outcomes, num_qbits):
+    """
+    Bit-pack measured outcome indices, each shot becomes ceil(num_qbits / 8) bytes.
+    Bits are ordered like the columns of measure_raw (qbit num_qbits - 1 first).
+
+    :param outcomes: np.array of shape (shots,), measured basis state indices
+    :param num_qbits: int, number of qbits
+    :return: np.array of uint8, shape (shots, ceil(num_qbits / 8))
+    """
+
+    return np.packbits(outcome_bits(outcomes, num_qbits), axis=1)
+
+
+def unpack_measurements(packed, num_qbits):
+    """
+    Inverse of pack_outcomes, recovers the raw measurements
+
+    :param packed: np.array of uint8, shape (shots, ceil(num_qbits / 8))
+    :param num_qbits: int, number of qbits
+    :return: np.array of uint8, shape (shots, num_qbits), same layout as measure_raw
+    """
+
+    return np.unpackbits(packed, axis=1, count=num_qbits)
+
+
+def random_states(num_states, num_qbits, real_valued_state=False, rng=None):
+    """
+    Batched version of random_state_gen, draws all the states at once as a
+    single array. Complex states are Haar random (normalized complex gaussian
+    vectors), real valued states follow random_state_gen (normalized uniform).
+
+    :param num_states: int, number of states to generate
+    :param num_qbits: int, number of qbits > 0
+    :param real_valued_state: bool, if true, produce states with only real valued coefficients
+    :param rng: np.random.Generator, optional, source of randomness
+    :return: np.array of shape (num_states, 2**num_qbits)
+    """
+
+    rng = np.random.default_rng(rng)
+    dim = 2**num_qbits
+
+    if real_valued_state:
+        psi = rng.uniform(size=(num_states, dim)).astype(complex)
+    else:
+        psi = rng.standard_normal((num_states, dim)) + 1j * rng.standard_normal((num_states, dim))
+
+    psi /= np.linalg.norm(psi, axis=1, keepdims=True)
+    return psi
+
+
+def chunk_rngs(num_chunks, seed=None):
+    """
+    Independent random number generators, one per chunk of a data set. The streams
+    are spawned from a single seed so parallel workers never overlap and each chunk
+    is reproducible on its own.
+
+    :param num_chunks: int, number of chunks
+    :param seed: int, optional, root seed (fresh entropy if None)
+    :return: list of np.random.Generator
+    """
+
+    return [np.random.default_rng(child) for child in np.random.SeedSequence(seed).spawn(num_chunks)]
+
+
+def generate_psi_data_set(file_name, shots=1000, num_qbits=3, binary=False, real_valued_state=False, seed=None,
+                          chunk_size=100_000, dtype=None):
     """
     Create a data set of radomly generated quantum states.
     Constructs a text file where each line corresponds to the quantum state.
     each comma seperated value is the complex coefficient to the basis states
     of an Nqbit state (basis states ordered from least to greatest left to right)
+    With binary=True a binary data set (file_name + '.qst', see data_io.py) is written instead.
+    The states are generated and written chunk_size at a time, each chunk with its own
+    random stream (see chunk_rngs).
 
     :param file_name: str, file name (not including .txt)
     :param shots: int, number of randomly generated states
     :param num_qbits: int, number of qbits in quantum state
+    :param binary: bool, write a binary data set instead of a text file
+    :param real_valued_state: bool, if true, produce states with only real valued coefficients
+    :param seed: int, optional, seed for reproducible data sets
+    :param chunk_size: int, number of states generated and written at a time
+    :param dtype: np.complex128 or np.complex64, precision of the states, precision.complex_dtype() if None
+                  (complex64 halves the binary data set and writes 9 instead of 17 significant digits to text)
     :return: None
     """
 
-    file = open(file_name + '.txt', 'w')
-
-    for index in range(shots):
-        psi = random_state_gen(num_qbits, real_valued_state=False)
-        psi_data = [str(i) for i in psi.data]
+    dtype = np.dtype(dtype or precision.complex_dtype())
+    starts = range(0, shots, chunk_size)
+    rngs = chunk_rngs(len(starts), seed=seed)
+
+    if binary:
+        psi_data, _ = data_io.create_dataset(file_name + '.qst', shots, num_qbits, dtype=dtype)
+        for start, rng in zip(starts, rngs):
+            count = min(chunk_size, shots - start)
+            psi_data[start:start + count] = random_states(count, num_qbits, real_valued_state, rng=rng)
+        psi_data.flush()
+        return
+
+    digits = 17 if dtype == np.complex128 else 9  # enough to round-trip a float64 / float32
+    row_format = ','.join([f'(%.{digits}g%+.{digits}gj)'] * 2**num_qbits) + '\n'
+    with open(file_name + '.txt', 'w') as file:
+        for start, rng in zip(starts, rngs):
+            count = min(chunk_size, shots - start)
+            psi = random_states(count, num_qbits, real_valued_state, rng=rng).astype(dtype)
+            file.write((row_format * count) % tuple(psi.view(psi.real.dtype).ravel()))  # one write per chunk
 
-        row = '{}'.format(psi_data[0])
-        for i in psi_data[1:]:
-            row += ',' + i
-
-        row += '\n'
-        file.write(row)
-
-    file.close()
     return
 
 
-def generate_raw_data_set(file_name, state_vect, shots=5000):
+def generate_raw_data_set(file_name, state_vect, shots=5000, binary=False, block_size=1_000_000, random_seed=1):
     """
     Generate a data set containing raw measurements for a quantum state.
     The first line in the text file is the quantum state, subsequent lines
     are the raw measurements obtained.
 
+    With binary=True the state is saved to (file_name + '_psi.npy') and the
+    shots are bit-packed (see pack_outcomes) into (file_name + '_shots.npy').
+    Shots are sampled and written block_size at a time so memory use does not
+    grow with the number of shots.
+
     :param file_name: str, name of text file
     :param state_vect: qiskit.QuantumCircuit object,
     :param shots: int, number of raw measurements
+    :param binary: bool, write bit-packed .npy files instead of a text file
+    :param block_size: int, number of shots sampled and written at a time
+    :param random_seed: int, for setting the 'randomness'
     :return: None
     """
 
+    rng = np.random.default_rng(random_seed)
+    num_qbits = state_vect.num_qubits
+    blocks = [min(block_size, shots - start) for start in range(0, shots, block_size)]
+
+    if binary:
+        np.save(file_name + '_psi.npy', state_vect.data)
+        packed = np.lib.format.open_memmap(file_name + '_shots.npy', mode='w+', dtype=np.uint8,
+                                           shape=(shots, (num_qbits + 7) // 8))
+        start = 0
+        for count in blocks:
+            packed[start:start + count] = pack_outcomes(sample_outcomes(state_vect, count, rng=rng), num_qbits)
+            start += count
+
+        packed.flush()
+        return
+
     file = open(file_name + '.txt', 'w')
 
     state_vect_lst = [str(i) for i in state_vect.data]
@@ -151,16 +331,10 @@ def generate_raw_data_set(file_name, state_vect, shots=5000):
     psi += '\n'
     file.write(psi)
 
-    measurements = measure_raw(state_vect, shots)
-    for x in measurements:
-        x_str_lst = [str(j) for j in x]
-        row = "{}".format(x_str_lst[0])
-
-        for x_str in x_str_lst[1:]:
-            row += ',' + x_str
-
-        row += '\n'
-        file.write(row)
+    row_format = ','.join(['%.1f'] * num_qbits) + '\n'
+    for count in blocks:
+        measurements = outcome_bits(sample_outcomes(state_vect, count, rng=rng), num_qbits)
+        file.write((row_format * count) % tuple(measurements.ravel()))  # one write per block
 
     file.close()
     return
@@ -168,6 +342,7 @@ def generate_raw_data_set(file_name, state_vect, shots=5000):
 
 def main():
     # generate_psi_data_set("3Qbit_psi_1k")
+    # generate_psi_data_set("3Qbit_psi_1k", binary=True)
     return
 
 
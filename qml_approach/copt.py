@@ -1,22 +1,38 @@
 # classical optimization suite
+import collections
+import multiprocessing as mp
+import time
 import numpy as np
-import scipy.optimize as opt
+import metrics
 import qpu
-optimizer_data = []
-optimizer_len = 0  # global constants to store info from optimizer calls
+GRADIENT_METHODS = ('adjoint', 'parameter_shift')
+FIT_DTYPE = np.complex128  # fits always simulate in double precision, single stalls near F = 1 - 1e-5
+_multistart_psi = None  # target state and stop flag shared with the multi-start worker processes
+_multistart_stop = None
 
 
-def get_fidelity(theta, psi):
+def get_fidelity(theta, psi, backend=qpu.DEFAULT_BACKEND, max_bond=None):
     """
     compute the fidelity between two quantum states (psi, phi) where
     psi is the target state and phi is the reconstructed state generated
     using VQCs.
 
     :param theta: np.array, containing the parameterization for the VQC
-    :param psi: qiskit.QuantumCircuit object, target state psi
+    :param psi: qiskit.QuantumCircuit object, target state psi (for the 'mps' backend also
+                an mps.MPS or a product state given as an np.array of shape (num_qbits, 2))
+    :param backend: str, simulation engine, one of qpu.BACKENDS
+    :param max_bond: int, optional, maximum bond dimension of the 'mps' backend (mps.DEFAULT_MAX_BOND if None)
     :return: float, fidelity between (0, 1)
     """
 
+    if backend == 'mps':
+        import mps
+        return mps.get_fidelity(theta, psi, max_bond=max_bond or mps.DEFAULT_MAX_BOND)
+
+    if backend == 'numpy':
+        phi = qpu.simulate_theta(theta, FIT_DTYPE)
+        return qpu.compute_overlap_fidelity(psi, phi)
+
     circ = qpu.construct_variational_circ(theta)
     phi = qpu.simulate_circ(circ)
     fidelity = qpu.compute_fidelity(psi, phi)
@@ -24,6 +40,22 @@ def get_fidelity(theta, psi):
     return fidelity
 
 
+def get_fidelity_batch(thetas, psi, dtype=None):
+    """
+    compute the fidelities between the target state psi and the states
+    reconstructed from a whole stack of parameterizations in one vectorized call.
+
+    :param thetas: np.array of shape (B, circ_depth, num_qbits), stack of parameterizations
+    :param psi: qiskit.Statevector or np.array, target state psi
+    :param dtype: complex dtype of the simulation, precision.complex_dtype() if None
+    :return: np.array of shape (B,), fidelities between (0, 1)
+    """
+
+    phis = qpu.simulate_thetas(thetas, dtype)
+    psi = np.asarray(getattr(psi, 'data', psi), dtype=phis.dtype)
+    return np.abs(phis @ np.conj(psi)) ** 2
+
+
 def get_loss(fidelity):
     """
     Get the loss between two states given the fidelity between them.
@@ -58,67 +90,251 @@ def compute_loss(theta_vector, *args):
     return loss
 
 
+@metrics.timed('copt.fidelity_gradient')
+def compute_fidelity_gradient(theta, psi, method='adjoint', phi=None):
+    """
+    Compute the fidelity and its gradient wrt the theta parameters. The 'adjoint'
+    method differentiates through the circuit with one forward and one backward
+    sweep, 'parameter_shift' evaluates the circuit at theta +/- pi/2 for every
+    parameter (2N simulations) and is kept for checking results.
+
+    :param theta: np.array, the parameterization matrix (circ_depth, num_qbits)
+    :param psi: qiskit.Statevector or np.array, target state psi
+    :param method: str, one of GRADIENT_METHODS
+    :param phi: np.array, optional, qpu.simulate_theta(theta) if already computed
+    :return: float fidelity and np.array of same shape as theta, the gradient
+    """
+
+    if phi is None:
+        phi = qpu.simulate_theta(theta, FIT_DTYPE)
+
+    if method == 'adjoint':
+        overlap = np.vdot(np.asarray(getattr(psi, 'data', psi)), phi)
+        d_overlap = qpu.overlap_gradient(theta, psi, phi=phi)
+
+        fidelity = float(np.abs(overlap) ** 2)
+        df_dtheta = 2 * np.real(np.conj(overlap) * d_overlap)  # d|<psi|phi>|^2 = 2 Re(<psi|phi>* d<psi|phi>)
+        return fidelity, df_dtheta
+
+    elif method == 'parameter_shift':
+        fidelity = qpu.compute_overlap_fidelity(psi, phi)
+
+        # shift each theta parameter by +/- pi/2 and evaluate all shifted circuits as one batch
+        shifts = np.reshape(np.eye(theta.size) * np.pi / 2, (theta.size,) + theta.shape)
+        fidelities = get_fidelity_batch(np.concatenate([theta + shifts, theta - shifts]), psi, phi.dtype)
+
+        df_dtheta = 0.5 * (fidelities[:theta.size] - fidelities[theta.size:])  # partial derivatives wrt theta
+        return fidelity, np.reshape(df_dtheta, theta.shape)
+
+    raise ValueError(f'unknown gradient method {method!r}, expected one of {GRADIENT_METHODS}')
+
+
 def compute_loss_gradient(theta_vector, *args):
     """
     Compute the gradient of our loss function. Since the loss is a scalar function
     over a vector parameter (thetas) we will have a vector valued gardient. We compute
     the gradient evaluated at (theta_vector). args is a list which contains the target state
-    psi (qiskit.QuantumCircuit object), the variational quantum circuit depth, and the number
-    of qbits.
+    psi (qiskit.QuantumCircuit object), the variational quantum circuit depth, the number
+    of qbits and optionally the gradient method (see GRADIENT_METHODS, default 'adjoint').
 
     :param theta_vector: np.array, the parameterization vector
-    :param args: list, contains [psi, circ_depth, num_qbits]
+    :param args: list, contains [psi, circ_depth, num_qbits, (method)]
     :return: np.array, of len = len(theta_vector), the gradient vector
     """
 
     psi = args[0]  # feed psi as a parameter
     circ_depth = args[1]
     num_qbits = args[2]
+    method = args[3] if len(args) > 3 else 'adjoint'
     theta = np.reshape(theta_vector, (circ_depth, num_qbits))  # reshapes the flat theta vector
-    fidelity = get_fidelity(theta, psi)
+    fidelity, df_dtheta = compute_fidelity_gradient(theta, psi, method=method)
 
     # the derivative of the loss wrt fidelity
     dl_df = -0.5 * fidelity ** (-0.5)
-
-    df_dtheta = []  # a list of partial derivatives of the fidelity wrt the theta parameters
-
-    for index in range(len(theta_vector)):
-        layer_index = index // num_qbits
-        qbit_index = index % num_qbits
-
-        theta_plus = np.copy(theta)
-        theta_plus[layer_index][qbit_index] += np.pi / 2  # added pi/2 to the ith theta parameter
-
-        theta_minus = np.copy(theta)
-        theta_minus[layer_index][qbit_index] -= np.pi / 2  # subtracted pi/2 to the ith theta parameter
-
-        df_dtheta_i = 0.5 * (get_fidelity(theta_plus, psi) - get_fidelity(theta_minus, psi))  # ith derivative
-        df_dtheta.append(df_dtheta_i)
-
-    df_dtheta = np.array(df_dtheta)
-    dl_dtheta = dl_df * df_dtheta  # chain rule to get partial derivative of loss wrt theta parameters
+    dl_dtheta = dl_df * np.reshape(df_dtheta, theta_vector.shape)  # chain rule to get partial derivative of loss wrt theta parameters
 
     return dl_dtheta
 
 
-def optimizer_callback(current_theta):
+class OptimizerSession:
     """
-    A function to store the state of the parameterization (theta) vector as it
-    gets optimized. This data is useful for tuning the optimization process.
-
-    :param current_theta: np.array, current iteration value of theta_vector
-    :return: bool, False constantly to prevent optimizer from truncating early
+    Holds everything recorded during a single optimization run (trajectory of
+    thetas, loss, fidelity and timing). Each run gets its own session so several
+    optimizations can safely run concurrently in one process.
+
+    The history can be bounded (history_size keeps only the most recent iterates)
+    and strided (history_stride records every n-th iterate) so long runs do not
+    hold every iterate in memory. The last iterate is always kept in final_theta.
+
+    The loss and gradient used by the optimizer are evaluated through the session,
+    which remembers the last few simulated states so that the loss, fidelity and
+    statevector of each iterate are recorded without simulating it again.
+
+    A run can be stopped early, once the fidelity reaches target_fidelity or
+    when stop_event (a threading or multiprocessing Event) is set. The callback
+    then raises _StopOptimization, which optimize_theta_scp catches around the
+    optimizer (scipy's own StopIteration handling needs scipy >= 1.11, and a
+    StopIteration escaping into a pool iterator silently ends the loop).
+
+    on_iteration is called after every iterate, e.g. to stream the run as it is
+    produced instead of waiting for the whole trajectory.
     """
 
-    global optimizer_data
-    global optimizer_len
-
-    optimizer_data.append(current_theta)
-    optimizer_len += 1
-    return False
-
-
-def optimize_theta_scp(theta, psi):
+    memo_size = 8  # number of recent evaluations kept for reuse
+
+    def __init__(self, psi, circ_depth, num_qbits, gradient='adjoint', history_size=None, history_stride=1,
+                 record_states=False, target_fidelity=None, stop_event=None, on_iteration=None):
+        """
+        :param psi: qiskit.Statevector or np.array, target state psi
+        :param circ_depth: int, number of layers in the variational circuit
+        :param num_qbits: int, number of qbits
+        :param gradient: str, how the loss gradient is computed, one of GRADIENT_METHODS
+        :param history_size: int or None, max number of iterates kept (None for unbounded)
+        :param history_stride: int, record every history_stride-th iterate
+        :param record_states: bool, also record the statevector |phi> of each iterate
+        :param target_fidelity: float, optional, stop once an iterate reaches this fidelity
+        :param stop_event: threading.Event or multiprocessing.Event, optional, stop once it is set
+        :param on_iteration: callable, optional, called as on_iteration(iteration, loss, fidelity, phi)
+                             after every iterate
+        """
+
+        self.psi = psi
+        self.circ_depth = circ_depth
+        self.num_qbits = num_qbits
+        self.gradient = gradient
+        self.history_stride = history_stride
+        self.record_states = record_states
+        self.target_fidelity = target_fidelity
+        self.stop_event = stop_event
+        self.on_iteration = on_iteration
+
+        self.thetas = collections.deque(maxlen=history_size)
+        self.losses = collections.deque(maxlen=history_size)
+        self.fidelities = collections.deque(maxlen=history_size)
+        self.times = collections.deque(maxlen=history_size)  # seconds since the start of the run
+        self.states = collections.deque(maxlen=history_size)  # only filled if record_states
+        self._evaluations = collections.OrderedDict()  # theta bytes -> (fidelity, phi)
+
+        self.iterations = 0
+        self.simulations = 0  # evaluations not served from the memo
+        self.gradient_evaluations = 0
+        self.phase_times = collections.Counter()  # seconds per phase, only filled if metrics are enabled
+        self.stopped_early = False
+        self.final_theta = None
+        self.start_time = None
+        self.wall_time = None
+
+    def evaluate(self, theta_vector):
+        """
+        Simulate the state for theta_vector and compute its fidelity, reusing a
+        recent evaluation at the same point if there is one.
+
+        :param theta_vector: np.array, the parameterization vector
+        :return: float fidelity and np.array, the statevector |phi>
+        """
+
+        key = np.asarray(theta_vector, dtype=float).tobytes()
+        if key in self._evaluations:
+            return self._evaluations[key]
+
+        start = time.perf_counter() if metrics.enabled else None
+        phi = qpu.simulate_theta(np.reshape(theta_vector, (self.circ_depth, self.num_qbits)), FIT_DTYPE)
+        fidelity = qpu.compute_overlap_fidelity(self.psi, phi)
+        self.simulations += 1
+        if start is not None:
+            self.phase_times['simulate_s'] += time.perf_counter() - start
+
+        self._remember(key, fidelity, phi)
+        return fidelity, phi
+
+    def _remember(self, key, fidelity, phi):
+        self._evaluations[key] = (fidelity, phi)
+        if len(self._evaluations) > self.memo_size:
+            self._evaluations.popitem(last=False)
+
+    def loss(self, theta_vector):
+        """
+        Same as compute_loss, passed to the optimizer as the objective
+        :param theta_vector: np.array, the parameterization vector
+        :return: float, loss
+        """
+
+        fidelity, phi = self.evaluate(theta_vector)
+        return get_loss(fidelity)
+
+    def loss_gradient(self, theta_vector):
+        """
+        Same as compute_loss_gradient, passed to the optimizer as the jacobian
+        :param theta_vector: np.array, the parameterization vector
+        :return: np.array, of len = len(theta_vector), the gradient vector
+        """
+
+        theta = np.reshape(theta_vector, (self.circ_depth, self.num_qbits))
+        fidelity, phi = self.evaluate(theta_vector)
+
+        start = time.perf_counter() if metrics.enabled else None
+        fidelity, df_dtheta = compute_fidelity_gradient(theta, self.psi, method=self.gradient, phi=phi)
+        self.gradient_evaluations += 1
+        if start is not None:
+            self.phase_times['gradient_s'] += time.perf_counter() - start
+
+        dl_df = -0.5 * fidelity ** (-0.5)
+        return dl_df * np.reshape(df_dtheta, np.shape(theta_vector))
+
+    def start(self):
+        """
+        Mark the start of the run, used as the reference for the recorded times
+        :return: None
+        """
+
+        self.start_time = time.perf_counter()
+
+    def stop(self):
+        """
+        Mark the end of the run and store the total wall time
+        :return: None
+        """
+
+        self.wall_time = time.perf_counter() - self.start_time
+
+    def callback(self, current_theta):
+        """
+        Store the state of the parameterization (theta) vector as it gets
+        optimized. Passed to the optimizer as its callback.
+
+        :param current_theta: np.array, current iteration value of theta_vector
+        :return: bool, False to prevent optimizer from truncating early (raises _StopOptimization to stop)
+        """
+
+        self.iterations += 1
+        self.final_theta = np.copy(current_theta)
+        fidelity, phi = self.evaluate(current_theta)  # already computed by the optimizer's last line search
+
+        if (self.iterations - 1) % self.history_stride == 0:
+            self.thetas.append(self.final_theta)
+            self.fidelities.append(fidelity)
+            self.losses.append(get_loss(fidelity))
+            self.times.append(time.perf_counter() - self.start_time)
+            if self.record_states:
+                self.states.append(phi)
+
+        if self.on_iteration is not None:
+            self.on_iteration(self.iterations, get_loss(fidelity), fidelity, phi)
+
+        reached_target = self.target_fidelity is not None and fidelity >= self.target_fidelity
+        if reached_target or (self.stop_event is not None and self.stop_event.is_set()):
+            self.stopped_early = True
+            raise _StopOptimization
+        return False
+
+
+class _StopOptimization(Exception):
+    # Raised by OptimizerSession.callback to end a run early, caught in optimize_theta_scp
+    pass
+
+
+def optimize_theta_scp(theta, psi, gradient='adjoint', session=None, method='BFGS', maxiter=100, tol=None,
+                       warm_start=None):
     """
     A function that determines the optimal parameterization vector (theta) for a
     variational quantum circuit in order to minimize the loss (the difference)
@@ -126,32 +342,148 @@ def optimize_theta_scp(theta, psi):
 
     :param theta: np.array, parameterization vector
     :param psi: qiskit.QuantumCircuit object, target state psi
+    :param gradient: str, how the loss gradient is computed, one of GRADIENT_METHODS
+    :param session: OptimizerSession, optional, records the run (a new one is created if None)
+    :param method: str, gradient based scipy.optimize.minimize method
+    :param maxiter: int, maximum number of optimizer iterations
+    :param tol: float, optional, tolerance for termination
+    :param warm_start: callable, optional, initialization strategy psi -> initial theta (replaces theta),
+                       e.g. wrapped_qml_method/warm_start.WarmStart
     :return: results from optimizer and list (optimizer data), which contains results between each iteration
     """
 
+    if warm_start is not None:
+        initial_theta = warm_start(psi)
+        if initial_theta.shape != theta.shape:
+            raise ValueError(f'warm start gave a theta of shape {initial_theta.shape}, expected {theta.shape}')
+        theta = initial_theta
+
     theta_vector = np.reshape(theta, theta.size)
     circ_depth, num_qbits = theta.shape
-    global optimizer_data
+    if session is None:
+        session = OptimizerSession(psi, circ_depth, num_qbits, gradient=gradient)
+
+    import scipy.optimize as opt  # imported on the first fit, see warm_up
+
+    session.start()
+    try:
+        results = opt.minimize(session.loss, theta_vector, method=method, jac=session.loss_gradient,
+                               callback=session.callback, tol=tol, options={'maxiter': maxiter})
+    except _StopOptimization:
+        # same fields as the result scipy returns, nfev and njev count the evaluations not served from the memo
+        fidelity, phi = session.evaluate(session.final_theta)
+        results = opt.OptimizeResult(x=session.final_theta, fun=get_loss(fidelity), success=False, status=99,
+                                     message='stopped early', nit=session.iterations,
+                                     nfev=session.simulations, njev=session.gradient_evaluations)
+    session.stop()
+
+    if metrics.enabled:
+        metrics.count('copt.fits')
+        metrics.count('copt.nfev', results.nfev)
+        metrics.count('copt.njev', results.get('njev', 0))
+        metrics.count('copt.iterations', session.iterations)
+        metrics.log_run('fit', num_qbits=num_qbits, circ_depth=circ_depth, method=method, gradient=session.gradient,
+                        nfev=results.nfev, njev=results.get('njev'), nit=results.get('nit'),
+                        iterations=session.iterations, simulations=session.simulations,
+                        gradient_evaluations=session.gradient_evaluations, wall_time_s=session.wall_time,
+                        fidelity=session.fidelities[-1] if session.fidelities else None,
+                        stopped_early=session.stopped_early, success=bool(results.success),
+                        **session.phase_times)
+
+    return results, list(session.thetas)
+
+
+def _init_multistart_worker(psi, stop_event):
+    """
+    Pool initializer, the target state is sent to every worker once instead of with every task
+    :param psi: np.array, target state psi
+    :param stop_event: multiprocessing.Event, set once any run reached the fidelity threshold
+    :return: None
+    """
+
+    global _multistart_psi, _multistart_stop
+    _multistart_psi = psi
+    _multistart_stop = stop_event
+
+
+def _multistart_run(job):
+    """
+    A single run of the multi-start driver, executed in a worker process
+    :param job: tuple, (start index, initial theta, options for optimize_theta_scp, fidelity threshold)
+    :return: results from optimizer and dict of statistics about the run
+    """
+
+    start, theta, options, fidelity_threshold = job
+    circ_depth, num_qbits = theta.shape
+    session = OptimizerSession(_multistart_psi, circ_depth, num_qbits, gradient=options['gradient'], history_size=1,
+                               target_fidelity=fidelity_threshold, stop_event=_multistart_stop)
 
-    results = opt.minimize(compute_loss, theta_vector, args=(psi, circ_depth, num_qbits), method='BFGS',
-                           jac=compute_loss_gradient, callback=optimizer_callback, options={'maxiter': 100})
+    results, optimizer_data = optimize_theta_scp(theta, _multistart_psi, session=session, method=options['method'],
+                                                 maxiter=options['maxiter'], tol=options['tol'])
+    fidelity = get_fidelity(np.reshape(results.x, theta.shape), _multistart_psi)
 
-    return results, optimizer_data
+    stats = {'start': start, 'fidelity': fidelity, 'loss': float(results.fun), 'nit': int(results.nit),
+             'nfev': int(results.nfev), 'njev': int(results.get('njev', 0)), 'wall_time': session.wall_time,
+             'stopped_early': session.stopped_early}
+    return results, stats
 
 
-def reset():
+def optimize_theta_multistart(psi, circ_depth, num_qbits, num_starts=8, processes=None, fidelity_threshold=None,
+                              seed=None, gradient='adjoint', method='BFGS', maxiter=100, tol=None):
     """
-    function to manually reset the globabl variables.
-    Should not be used (only for emergancies)
-    :return: None
+    Multi-start driver for optimize_theta_scp. Launches num_starts optimizations from
+    different initial thetas (all zeros for the first one, uniformly random in
+    [-pi, pi) for the others) across a process pool and returns the best one.
+    Once any run reaches fidelity_threshold, all the other runs are told to stop.
+
+    :param psi: qiskit.Statevector or np.array, target state psi
+    :param circ_depth: int, number of layers in the variational circuit
+    :param num_qbits: int, number of qbits
+    :param num_starts: int, number of optimizations to launch
+    :param processes: int, number of worker processes (all cores if None)
+    :param fidelity_threshold: float, optional, stop all runs once one reaches this fidelity
+    :param seed: int, optional, seed for the random initial thetas
+    :param gradient: str, how the loss gradient is computed, one of GRADIENT_METHODS
+    :param method: str, gradient based scipy.optimize.minimize method
+    :param maxiter: int, maximum number of optimizer iterations per run
+    :param tol: float, optional, tolerance for termination
+    :return: results from the best run and a list of dicts with statistics for every run
     """
 
-    global optimizer_data
-    global optimizer_len
+    rng = np.random.default_rng(seed)
+    thetas = [np.zeros((circ_depth, num_qbits))]
+    thetas += [rng.uniform(-np.pi, np.pi, (circ_depth, num_qbits)) for start in range(1, num_starts)]
+    options = {'gradient': gradient, 'method': method, 'maxiter': maxiter, 'tol': tol}
+    jobs = [(start, theta, options, fidelity_threshold) for start, theta in enumerate(thetas)]
 
-    optimizer_data = []
-    optimizer_len = 0
-    return
+    psi = np.asarray(getattr(psi, 'data', psi))
+    stop_event = mp.Event()
+    best_results, best_fidelity, run_stats = None, -1, []
+
+    warm_up(num_qbits=[num_qbits], qiskit=False)  # forked workers inherit the imports
+    with mp.Pool(processes, initializer=_init_multistart_worker, initargs=(psi, stop_event)) as pool:
+        for results, stats in pool.imap_unordered(_multistart_run, jobs):
+            run_stats.append(stats)
+            if stats['fidelity'] > best_fidelity:
+                best_results, best_fidelity = results, stats['fidelity']
+            if fidelity_threshold is not None and stats['fidelity'] >= fidelity_threshold:
+                stop_event.set()
+
+    run_stats.sort(key=lambda stats: stats['start'])
+    return best_results, run_stats
+
+
+def warm_up(num_qbits=range(1, 7), qiskit=True):
+    """
+    Preload scipy.optimize and the simulation caches (see qpu.warm_up) before the
+    first fit, e.g. in a parent process before it forks its workers
+    :param num_qbits: iterable of ints, numbers of qbits to prepare the simulation for
+    :param qiskit: bool, also import qiskit
+    :return: None
+    """
+
+    import scipy.optimize
+    qpu.warm_up(num_qbits=num_qbits, qiskit=qiskit)
 
 
 def main():
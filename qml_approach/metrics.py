@@ -0,0 +1,145 @@
+# opt-in instrumentation: per phase timers, counters and structured per run logs
+import collections
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+enabled = os.environ.get('QST_METRICS', '') not in ('', '0')  # off unless QST_METRICS=1 or enable()
+
+logger = logging.getLogger('qst.metrics')
+
+_lock = threading.Lock()
+_counters = collections.Counter()
+_timers = {}  # name -> [calls, total seconds, max seconds]
+
+
+def enable(on=True):
+    """
+    Turn the instrumentation on or off for this process. Per run logs are
+    written as json lines to stderr unless the 'qst.metrics' logger is already
+    configured.
+
+    :param on: bool, record metrics
+    :return: None
+    """
+
+    global enabled
+    enabled = on
+    if on and not logger.handlers:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+
+
+if enabled:
+    enable()  # QST_METRICS set, also configure the log handler
+
+
+def count(name, value=1):
+    # Add value to a counter, does nothing when disabled
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] += value
+
+
+def record(name, seconds):
+    # Add a measured duration to the timer name (callers check enabled)
+    with _lock:
+        timer = _timers.setdefault(name, [0, 0.0, 0.0])
+        timer[0] += 1
+        timer[1] += seconds
+        timer[2] = max(timer[2], seconds)
+
+
+class _Timer:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_null_timer = _NullTimer()
+
+
+def timer(name):
+    """
+    Context manager timing the enclosed block under name (a shared no-op when disabled)
+    :param name: str, name of the phase, e.g. 'qpu.simulate'
+    """
+
+    return _Timer(name) if enabled else _null_timer
+
+
+def timed(name):
+    """
+    Decorator timing every call of the function under name. When disabled the
+    only cost is the check of the enabled flag.
+
+    :param name: str, name of the phase
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def log_run(event, **fields):
+    """
+    Write a structured (json) log line for a finished run, e.g. one fit, when enabled
+    :param event: str, kind of run, e.g. 'fit'
+    :param fields: json serializable values describing the run
+    :return: None
+    """
+
+    if enabled:
+        logger.info(json.dumps({'event': event, 'time': time.time(), **fields}, default=float))
+
+
+def snapshot():
+    """
+    :return: dict, current counters and timers (calls, total, mean and max seconds of each phase)
+    """
+
+    with _lock:
+        timers = {name: {'calls': calls, 'total_s': total, 'mean_s': total / calls, 'max_s': longest}
+                  for name, (calls, total, longest) in _timers.items()}
+        return {'enabled': enabled, 'pid': os.getpid(), 'counters': dict(_counters), 'timers': timers}
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _timers.clear()
@@ -0,0 +1,313 @@
+# matrix product state (MPS) simulation of the variational circuit, for targets too wide for a dense statevector
+import numpy as np
+import qpu
+
+DEFAULT_MAX_BOND = 32  # bond dimension kept by the truncation (exact for num_qbits <= 2 * log2(max_bond))
+DEFAULT_CUTOFF = 1e-12  # singular values below cutoff * largest singular value are dropped
+
+
+class MPS:
+    """
+    Matrix product state of num_qbits qbits. Site k holds qbit k (qiskit ordering,
+    qbit 0 is the least significant bit of the dense index) as a tensor of shape
+    (left bond, 2, right bond). The state is kept in mixed canonical form around
+    self.center so truncating a bond after a two qbit gate is optimal.
+
+    Memory and time scale with num_qbits * max_bond**2 instead of 2**num_qbits.
+    """
+
+    def __init__(self, tensors, center=0):
+        """
+        :param tensors: list of np.array of shape (left bond, 2, right bond), one per qbit
+        :param center: int, orthogonality center (every tensor left of it is left canonical
+                       and every tensor right of it right canonical)
+        """
+
+        self.tensors = [np.asarray(tensor, dtype=complex) for tensor in tensors]
+        self.center = center
+        self.truncation_error = 0.0  # total discarded weight (squared singular values)
+
+    @classmethod
+    def zero_state(cls, num_qbits):
+        """
+        :param num_qbits: int, number of qbits
+        :return: MPS, the state |0...0>
+        """
+
+        return cls.from_product(np.tile([1, 0], (num_qbits, 1)))
+
+    @classmethod
+    def from_product(cls, states):
+        """
+        Product state, bond dimension 1
+        :param states: np.array of shape (num_qbits, 2), the state of each qbit (row k is qbit k)
+        :return: MPS
+        """
+
+        states = np.asarray(states, dtype=complex)
+        states = states / np.linalg.norm(states, axis=1, keepdims=True)
+        return cls([np.reshape(state, (1, 2, 1)) for state in states])
+
+    @classmethod
+    def from_statevector(cls, psi, max_bond=None, cutoff=DEFAULT_CUTOFF):
+        """
+        Decompose a dense statevector with successive SVDs (only for targets small enough to be dense)
+        :param psi: qiskit.Statevector or np.array of shape (2**num_qbits,)
+        :param max_bond: int, optional, maximum bond dimension kept
+        :param cutoff: float, relative cutoff on the singular values
+        :return: MPS
+        """
+
+        psi = np.asarray(getattr(psi, 'data', psi), dtype=complex)
+        num_qbits = int(np.log2(len(psi)))
+        # axis k of the reshaped vector must be qbit k, the dense index has qbit 0 last
+        rest = np.transpose(np.reshape(psi, (2,) * num_qbits)).reshape(1, -1)
+
+        tensors = []
+        for site in range(num_qbits - 1):
+            left = rest.shape[0]
+            u, s, vh, error = _truncated_svd(np.reshape(rest, (left * 2, -1)), max_bond, cutoff)
+            tensors.append(np.reshape(u, (left, 2, -1)))
+            rest = s[:, np.newaxis] * vh
+        tensors.append(np.reshape(rest, (rest.shape[0], 2, 1)))
+
+        return cls(tensors, center=num_qbits - 1)
+
+    @property
+    def num_qbits(self):
+        return len(self.tensors)
+
+    @property
+    def bond_dims(self):
+        return [tensor.shape[2] for tensor in self.tensors[:-1]]
+
+    def copy(self):
+        copy = MPS([np.copy(tensor) for tensor in self.tensors], center=self.center)
+        copy.truncation_error = self.truncation_error
+        return copy
+
+    def move_center(self, site):
+        """
+        Move the orthogonality center to site with QR decompositions
+        :param site: int, new orthogonality center
+        :return: None
+        """
+
+        while self.center < site:
+            tensor = self.tensors[self.center]
+            left, _, right = tensor.shape
+            q, r = np.linalg.qr(np.reshape(tensor, (left * 2, right)))
+            self.tensors[self.center] = np.reshape(q, (left, 2, -1))
+            self.tensors[self.center + 1] = np.einsum('ab,bsc->asc', r, self.tensors[self.center + 1])
+            self.center += 1
+
+        while self.center > site:
+            tensor = self.tensors[self.center]
+            left, _, right = tensor.shape
+            q, r = np.linalg.qr(np.reshape(tensor, (left, 2 * right)).T)
+            self.tensors[self.center] = np.reshape(q.T, (-1, 2, right))
+            self.tensors[self.center - 1] = np.einsum('asb,cb->asc', self.tensors[self.center - 1], r)
+            self.center -= 1
+
+    def apply_gate(self, gate, qbit):
+        """
+        Apply a single qbit gate, in place (keeps the canonical form)
+        :param gate: np.array of shape (2, 2)
+        :param qbit: int, the qbit the gate acts on
+        :return: None
+        """
+
+        self.tensors[qbit] = np.einsum('ij,ajb->aib', gate, self.tensors[qbit])
+
+    def apply_cx(self, control, target, max_bond=DEFAULT_MAX_BOND, cutoff=DEFAULT_CUTOFF):
+        """
+        Apply a cx gate between neighbouring qbits, in place, then truncate the bond between them
+        :param control: int, control qbit
+        :param target: int, target qbit, control +- 1
+        :param max_bond: int or None, maximum bond dimension kept (None for no limit)
+        :param cutoff: float, relative cutoff on the singular values
+        :return: None
+        """
+
+        if abs(control - target) != 1:
+            raise ValueError(f'cx({control}, {target}) does not act on neighbouring qbits')
+
+        site = min(control, target)
+        self.move_center(site)
+        pair = np.einsum('asb,btc->astc', self.tensors[site], self.tensors[site + 1])
+
+        pair = np.copy(pair)
+        if control < target:  # flip the target (right) qbit where the control (left) qbit is 1
+            pair[:, 1] = pair[:, 1, ::-1]
+        else:
+            pair[:, :, 1] = pair[:, ::-1, 1]
+
+        left, _, _, right = pair.shape
+        u, s, vh, error = _truncated_svd(np.reshape(pair, (left * 2, 2 * right)), max_bond, cutoff)
+        self.tensors[site] = np.reshape(u, (left, 2, -1))
+        self.tensors[site + 1] = np.reshape(s[:, np.newaxis] * vh, (-1, 2, right))
+        self.center = site + 1
+        self.truncation_error += error
+
+    def overlap(self, other):
+        """
+        <self|other> contracted site by site, never building the dense vectors
+        :param other: MPS, same number of qbits
+        :return: complex, the overlap
+        """
+
+        if other.num_qbits != self.num_qbits:
+            raise ValueError(f'overlap of a {self.num_qbits} qbit and a {other.num_qbits} qbit state')
+
+        environment = np.ones((1, 1), dtype=complex)
+        for bra, ket in zip(self.tensors, other.tensors):
+            environment = np.einsum('ab,asc,bsd->cd', environment, np.conj(bra), ket, optimize=True)
+        return environment[0, 0]
+
+    def norm(self):
+        return float(np.sqrt(np.abs(self.overlap(self))))
+
+    def to_statevector(self):
+        """
+        Contract into a dense statevector (qiskit ordering), only feasible for few qbits
+        :return: np.array of shape (2**num_qbits,)
+        """
+
+        state = np.ones((1, 1), dtype=complex)
+        for tensor in self.tensors:
+            state = np.einsum('xa,asb->xsb', state, tensor).reshape(-1, tensor.shape[2])
+        # the row index has qbit 0 as its most significant bit, reverse to qiskit ordering
+        state = np.reshape(state, (2,) * self.num_qbits)
+        return np.transpose(state).reshape(-1)
+
+
+def _truncated_svd(matrix, max_bond, cutoff):
+    # SVD keeping at most max_bond singular values above cutoff * largest, renormalized
+    u, s, vh = np.linalg.svd(matrix, full_matrices=False)
+    keep = max(1, int(np.sum(s > cutoff * s[0]))) if s[0] > 0 else 1
+    if max_bond is not None:
+        keep = min(keep, max_bond)
+
+    error = float(np.sum(s[keep:] ** 2) / np.sum(s ** 2)) if s[0] > 0 else 0.0
+    s = s[:keep] * np.linalg.norm(s) / np.linalg.norm(s[:keep]) if s[0] > 0 else s[:keep]
+    return u[:, :keep], s, vh[:keep], error
+
+
+def as_mps(psi, max_bond=None):
+    """
+    Convert a target state to an MPS
+    :param psi: MPS, np.array of shape (num_qbits, 2) (product state, row k is qbit k),
+                or a dense qiskit.Statevector / np.array of shape (2**num_qbits,)
+    :param max_bond: int, optional, maximum bond dimension when decomposing a dense state
+    :return: MPS
+    """
+
+    if isinstance(psi, MPS):
+        return psi
+
+    psi = np.asarray(getattr(psi, 'data', psi))
+    if psi.ndim == 2 and psi.shape[1] == 2:
+        return MPS.from_product(psi)
+    return MPS.from_statevector(psi, max_bond=max_bond)
+
+
+def simulate_theta(theta, max_bond=DEFAULT_MAX_BOND, cutoff=DEFAULT_CUTOFF):
+    """
+    Same circuit as qpu.simulate_theta, simulated as an MPS. Exact as long as
+    no bond is truncated, see MPS.truncation_error.
+
+    :param theta: np.array, the parameterization matrix (circ_depth, num_qbits)
+    :param max_bond: int or None, maximum bond dimension (None for exact simulation)
+    :param cutoff: float, relative cutoff on the singular values
+    :return: MPS, the state |phi>
+    """
+
+    circ_depth, num_qbits = np.shape(theta)
+    phi = MPS.zero_state(num_qbits)
+
+    for layer in range(circ_depth):
+        gate = qpu.layer_gate(layer, circ_depth)
+        for qbit in range(num_qbits):
+            phi.apply_gate(gate(theta[layer][qbit]), qbit)
+
+        if layer != circ_depth - 1:  # bonus layer at the end has no cx
+            for control, target in qpu.layer_cx_pairs(layer, num_qbits):
+                phi.apply_cx(control, target, max_bond=max_bond, cutoff=cutoff)
+
+    return phi
+
+
+def get_fidelity(theta, psi, max_bond=DEFAULT_MAX_BOND):
+    """
+    Fidelity |<psi|phi>|^2 between the target and the state phi reconstructed from theta
+    :param theta: np.array, the parameterization matrix (circ_depth, num_qbits)
+    :param psi: target state, see as_mps
+    :param max_bond: int or None, maximum bond dimension of phi
+    :return: float, fidelity
+    """
+
+    phi = simulate_theta(theta, max_bond=max_bond)
+    return float(np.abs(as_mps(psi).overlap(phi)) ** 2)
+
+
+def overlap_gradient(theta, psi, max_bond=DEFAULT_MAX_BOND):
+    """
+    Overlap <psi|phi(theta)> and its gradient wrt every theta parameter. Every
+    rotation satisfies d/dt R(t) = R(t + pi) / 2, so each derivative is half the
+    overlap with that one angle shifted by pi (one MPS simulation per parameter).
+
+    :param theta: np.array, the parameterization matrix (circ_depth, num_qbits)
+    :param psi: MPS, the target state
+    :param max_bond: int or None, maximum bond dimension of phi
+    :return: complex overlap and np.array of complex, same shape as theta, d<psi|phi>/dtheta
+    """
+
+    theta = np.asarray(theta, dtype=float)
+    overlap = psi.overlap(simulate_theta(theta, max_bond=max_bond))
+    grad = np.zeros(theta.shape, dtype=complex)
+
+    for index in np.ndindex(theta.shape):
+        shifted = np.copy(theta)
+        shifted[index] += np.pi
+        grad[index] = 0.5 * psi.overlap(simulate_theta(shifted, max_bond=max_bond))
+
+    return overlap, grad
+
+
+def optimize_theta_mps(theta, psi, max_bond=DEFAULT_MAX_BOND, method='BFGS', maxiter=100, tol=None):
+    """
+    Same as copt.optimize_theta_scp (loss 1 - sqrt(fidelity)), with the states
+    simulated as MPS, so wide targets can be fitted without a dense statevector.
+
+    :param theta: np.array, initial parameterization matrix (circ_depth, num_qbits)
+    :param psi: target state, see as_mps
+    :param max_bond: int or None, maximum bond dimension of phi
+    :param method: str, gradient based scipy.optimize.minimize method
+    :param maxiter: int, maximum number of optimizer iterations
+    :param tol: float, optional, tolerance for termination
+    :return: results from optimizer and list (optimizer data), theta after each iteration
+    """
+
+    import scipy.optimize as opt  # imported on the first fit
+
+    psi = as_mps(psi)
+    optimizer_data = []
+
+    def loss_and_gradient(theta_vector):
+        overlap, d_overlap = overlap_gradient(np.reshape(theta_vector, theta.shape), psi, max_bond=max_bond)
+        fidelity = max(np.abs(overlap) ** 2, 1e-300)
+        df_dtheta = 2 * np.real(np.conj(overlap) * d_overlap)
+        return 1 - np.sqrt(fidelity), np.ravel(-0.5 * fidelity ** (-0.5) * df_dtheta)
+
+    results = opt.minimize(loss_and_gradient, np.ravel(theta), method=method, jac=True,
+                           callback=optimizer_data.append, tol=tol, options={'maxiter': maxiter})
+
+    return results, optimizer_data
+
+
+def main():
+    return
+
+
+if __name__ == "__main__":
+    main()
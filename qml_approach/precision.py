@@ -0,0 +1,104 @@
+# numerical precision shared by the simulation engine, data sets, NN inputs and serialization
+import os
+import numpy as np
+
+PRECISIONS = {  # name -> (complex dtype, float dtype)
+    'double': (np.complex128, np.float64),
+    'single': (np.complex64, np.float32),
+}
+
+# 'single' halves memory and bandwidth, see check_accuracy for what it costs in accuracy
+precision = os.environ.get('QST_PRECISION', 'double')
+if precision not in PRECISIONS:
+    raise ValueError(f'unknown QST_PRECISION {precision!r}, expected one of {tuple(PRECISIONS)}')
+
+
+def set_precision(name):
+    """
+    Set the precision used from now on in this process (also settable with QST_PRECISION)
+    :param name: str, 'double' (complex128 / float64) or 'single' (complex64 / float32)
+    :return: None
+    """
+
+    global precision
+    if name not in PRECISIONS:
+        raise ValueError(f'unknown precision {name!r}, expected one of {tuple(PRECISIONS)}')
+    precision = name
+
+
+def complex_dtype(name=None):
+    # complex dtype of the given precision (the current one if None)
+    return PRECISIONS[name or precision][0]
+
+
+def float_dtype(name=None):
+    # float dtype of the given precision (the current one if None)
+    return PRECISIONS[name or precision][1]
+
+
+def to_precision(value, name=None):
+    """
+    Round a float to the given precision for serialization. Single precision
+    values come back as the shortest decimal that round-trips through float32,
+    so e.g. json writes 0.1 instead of 0.10000000149011612.
+
+    :param value: float
+    :param name: str, precision (the current one if None)
+    :return: float
+    """
+
+    if (name or precision) == 'double':
+        return float(value)
+    return float(str(np.float32(value)))
+
+
+def check_accuracy(num_qbits=range(2, 11), circ_depth=10, num_thetas=100, seed=1):
+    """
+    Accuracy check of single against double precision simulation. For random
+    thetas and random target states it compares the statevectors and the
+    fidelities computed by qpu.simulate_thetas in both precisions.
+
+    Measured with the defaults: amplitudes agree to 3e-7 and fidelities to 6e-7
+    (1.3e-5 relative) from 2 to 10 qbits, norms stay within 7e-7 of 1. That is
+    far below shot noise, but too coarse for the optimizer to get past
+    fidelities of about 1 - 1e-5, so fits always run in double precision
+    (see copt.FIT_DTYPE).
+
+    :param num_qbits: iterable of ints, numbers of qbits to check
+    :param circ_depth: int, depth of the variational circuit
+    :param num_thetas: int, number of random parameterizations per number of qbits
+    :param seed: int, seed of the random thetas and targets
+    :return: list of dicts, max amplitude and fidelity errors per number of qbits
+    """
+
+    import qpu
+
+    rng = np.random.default_rng(seed)
+    report = []
+    for qbits in num_qbits:
+        thetas = rng.uniform(-np.pi, np.pi, (num_thetas, circ_depth, qbits))
+        psi = rng.standard_normal(2**qbits) + 1j * rng.standard_normal(2**qbits)
+        psi /= np.linalg.norm(psi)
+
+        states = {name: qpu.simulate_thetas(thetas, complex_dtype(name)) for name in PRECISIONS}
+        fidelities = {name: np.abs(phis @ np.conj(psi).astype(phis.dtype)) ** 2 for name, phis in states.items()}
+        fidelity_error = np.abs(fidelities['single'] - fidelities['double'])
+        report.append({
+            'num_qbits': qbits,
+            'max_amplitude_error': float(np.max(np.abs(states['single'] - states['double']))),
+            'max_fidelity_error': float(np.max(fidelity_error)),
+            'max_relative_fidelity_error': float(np.max(fidelity_error / fidelities['double'])),
+            'max_norm_error': float(np.max(np.abs(np.linalg.norm(states['single'], axis=1) - 1))),
+        })
+
+    return report
+
+
+def main():
+    for row in check_accuracy():
+        print(row)
+    return
+
+
+if __name__ == '__main__':
+    main()
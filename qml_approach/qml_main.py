@@ -1,26 +1,39 @@
 from __future__ import division
+import contextlib
+import functools
 import multiprocessing as mp
 import numpy as np
+import os
 import random
-from qiskit import *
-from qiskit.quantum_info import random_statevector
+import sys
+import time
 import copt
+import metrics
+import precision
+
+data_gen = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data_gen')
+sys.path.insert(1, data_gen)
+
+import data_io
 
 
 random.seed(1)   # setting random seed to 1 for reproducibility
 random_seed = 1  # setting the random seed inside the statevector
 
 
-def generate_random_psi(num_qbits=2, debug=False):
+def generate_random_psi(num_qbits=2, debug=False, seed=random_seed):
     """
     Initialize our target state |psi>
     :param num_qbits: int, number of qbits
     :param debug: bool, will print |psi>
+    :param seed: int, seed of the random state, the same seed always gives the same |psi>
     :return: qiskit.quantum_info Statevector object
     """
 
+    from qiskit.quantum_info import random_statevector  # heavy, imported on first use
+
     dim = 2**num_qbits
-    psi = random_statevector(dim, seed=random_seed)
+    psi = random_statevector(dim, seed=seed)
     if debug:
         print(psi)
 
@@ -39,7 +52,8 @@ def initialize_theta(circ_depth=10, num_qbits=2):
     return theta
 
 
-def multi_processing_attempt(file_name):
+def multi_processing_attempt(file_name, circ_depth=8, num_qbits=None, maxiter=100, method='BFGS', tol=None,
+                             processes=None, chunksize=4, resume=True, binary=False):
     """
     file contains a list of quantum states (psi). This is a method for learning
     the parameterization vectors (theta) for an array of quantum states (psi)
@@ -48,58 +62,187 @@ def multi_processing_attempt(file_name):
     named (file_name + '_newPsi.txt') which contains the states (psi) so
     that the 1st parameterization theta corresponds to the first state psi.
 
+    circ_depth may also be a list of depths to sweep over in one pass, each
+    parsed state is then learned at every depth and the results are written
+    to (file_name + '_newTheta_depth{circ_depth}.txt'), one file per depth.
+
+    With binary=True the pairs are instead written to a binary data set
+    (see data_gen/data_io.py) named (file_name + '_new.qst'), or
+    (file_name + '_new_depth{circ_depth}.qst') for a sweep, where row i holds
+    the i-th state of file_name.
+
+    The states are streamed from the file and each (psi, theta) pair is written
+    as soon as it is learned. The index (line number in file_name) of every
+    written pair is appended to (file_name + '_progress.txt'), which acts as a
+    checkpoint: re-running with resume=True (and the same depths) skips the
+    states already done. Without a progress file the outputs are overwritten.
+
     :param file_name: str, name of file containing list of states psi
+    :param circ_depth: int or list of ints, depth(s) of the variational circuit
+    :param num_qbits: int, num qbits for state psi (inferred from psi if None)
+    :param maxiter: int, maximum number of optimizer iterations per state
+    :param method: str, gradient based scipy.optimize.minimize method
+    :param tol: float, optional, optimizer tolerance for termination
+    :param processes: int, number of worker processes (all cores if None)
+    :param chunksize: int, number of states sent to a worker at a time
+    :param resume: bool, continue from the checkpoint (if there is one) instead of starting over
+    :param binary: bool, write a binary data set instead of text files (stored in precision.precision,
+                   text thetas are rounded to it as well)
     :return: none
     """
 
-    file = open(file_name, 'r')
-    psi_lst = file.readlines()
-    file.close()
+    base_name = file_name.split('.')[0]
+    circ_depths = [int(depth) for depth in np.atleast_1d(circ_depth)]
+    suffixes = [''] if len(circ_depths) == 1 else [f'_depth{depth}' for depth in circ_depths]
+    progress = base_name + '_progress.txt'
+    processes = processes or mp.cpu_count()
+    resume = resume and os.path.exists(progress)  # outputs of a run without checkpoint are not appended to
+
+    with open(file_name, 'r') as file:
+        total, dim = 0, None
+        for total, line in enumerate(file, 1):
+            if total == 1:
+                dim = len(line.split(','))
+
+    if binary:
+        data_sets = [base_name + f'_new{suffix}.qst' for suffix in suffixes]
+        done = _read_checkpoint(progress, []) if resume else set()
+        if done:
+            outputs = [data_io.open_dataset(path, mode='r+')[1:] for path in data_sets]
+        else:
+            outputs = [data_io.create_dataset(path, total, int(np.log2(dim)), circ_depth=depth,
+                                              dtype=precision.complex_dtype())
+                       for path, depth in zip(data_sets, circ_depths)]
+    else:
+        new_psi = base_name + '_newPsi.txt'
+        new_thetas = [base_name + f'_newTheta{suffix}.txt' for suffix in suffixes]
+        done = _read_checkpoint(progress, [new_psi] + new_thetas) if resume else set()
+
+    if done and len(done) >= total:
+        print(f"Nothing to do, all {total} states are already in {progress}. Delete it or pass resume=False "
+              f"to start over")
+        return
+
+    mode = 'a' if resume else 'w'
+    job = functools.partial(pool_function, circ_depths=circ_depths, num_qbits=num_qbits,
+                            maxiter=maxiter, method=method, tol=tol)
+
+    with contextlib.ExitStack() as stack:
+        file = stack.enter_context(open(file_name, 'r'))
+        if not binary:
+            P = stack.enter_context(open(new_psi, mode))
+            T_lst = [stack.enter_context(open(new_theta, mode)) for new_theta in new_thetas]
+        C = stack.enter_context(open(progress, mode))
+        copt.warm_up(num_qbits=[int(np.log2(dim))], qiskit=False)  # forked workers inherit the imports
+        p = stack.enter_context(mp.Pool(processes))
+
+        print(f"Multiprocessing Pool created! Running with {processes} of your {mp.cpu_count()} cores")
+        if done:
+            print(f"Resuming, {len(done)} of {total} states already done")
+
+        jobs = ((index, line) for index, line in enumerate(file) if index not in done)
+        start_time = time.perf_counter()
+        learned = 0
+
+        for i, entry in enumerate(p.imap_unordered(job, jobs, chunksize=chunksize), 1):
+            index, line, psi_vect, thetas = entry
+            learned = i
+            if binary:
+                for (psi_data, theta_data), theta in zip(outputs, thetas):
+                    psi_data[index] = psi_vect
+                    theta_data[index] = theta
+                    psi_data.flush()
+                    theta_data.flush()
+            else:
+                P.write(line)
+                P.flush()
+                for T, theta in zip(T_lst, thetas):
+                    theta_str_lst = [str(value) for value in np.ravel(theta).astype(precision.float_dtype())]
+                    T.write(",".join(theta_str_lst) + "\n")
+                    T.flush()
+            C.write(f'{index}\n')  # checkpoint only once the pair is on disk
+            C.flush()
+
+            elapsed = time.perf_counter() - start_time
+            rate = i / elapsed
+            remaining = total - len(done) - i
+            print('\rdone {0:.1%} ({1:.2f} states/s, ETA {2:.0f}s)'.format(
+                (len(done) + i) / total, rate, remaining / rate), end='')
+
+    print()
+    elapsed = time.perf_counter() - start_time
+    metrics.log_run('data_set', file_name=file_name, circ_depths=circ_depths, states=learned,
+                    resumed=len(done), wall_time_s=elapsed, states_per_s=learned / elapsed if elapsed else None)
+    return
 
-    new_psi = file_name.split('.')[0] + '_newPsi.txt'
-    new_theta = file_name.split('.')[0] + '_newTheta.txt'
-    with open(new_psi, 'w') as P, open(new_theta, 'w') as T:
-        p = mp.Pool(mp.cpu_count())
-        print(f"Multiprocessing Pool created! Running with all {mp.cpu_count()} of your cores")
 
-        for i, entry in enumerate(p.map(pool_function, psi_lst), 1):
-            print('\rdone {0:%}'.format(i / len(psi_lst)))
-            line, row = entry
-            P.write(line)
-            T.write(row)
+def _read_checkpoint(progress, paths):
+    """
+    Read the indices of the states already learned from the progress file and
+    drop any partially written lines past the checkpoint from the output files.
 
-    return
+    :param progress: str, path of the progress file
+    :param paths: list of str, paths of the psi and theta output files
+    :return: set of ints, indices of the states already done
+    """
+
+    if not os.path.exists(progress):
+        return set()
+
+    with open(progress, 'r') as C:
+        indices = [int(line) for line in C if line.strip()]
 
+    for path in paths:  # keep only the pairs recorded in the checkpoint
+        if not os.path.exists(path):
+            continue
+        with open(path, 'r') as file:
+            lines = file.readlines()[:len(indices)]
+        with open(path, 'w') as file:
+            file.writelines(lines)
 
-def pool_function(line):
+    return set(indices)
+
+
+def pool_function(job, circ_depths=(8,), num_qbits=None, maxiter=100, method='BFGS', tol=None):
     """
     Reads in the quantum state (psi) and runs the QML method to
-    determine the associated parameterization (theta). returns
-    a list containing the [psi, theta] written as strings.
-
-    :param line: str, the quantum state psi, written as a str
-    :return: list of len 2, containing the str psi (quantum state) and str theta (parameterization)
+    determine the associated parameterization (theta) at every requested
+    circuit depth. returns a list containing the index of the state, psi
+    (as the original str and as an array) and the thetas.
+
+    :param job: tuple, (index, line) index of the state and the quantum state psi, written as a str
+    :param circ_depths: list of ints, depths of the variational circuit
+    :param num_qbits: int, num qbits for state psi (inferred from psi if None)
+    :param maxiter: int, maximum number of optimizer iterations
+    :param method: str, gradient based scipy.optimize.minimize method
+    :param tol: float, optional, optimizer tolerance for termination
+    :return: list of len 4, containing the index, the str psi, the np.array psi and a list of np.array theta (one per depth)
     """
-    #     :param circ_depth: int, representing depth of VQC ## need to fix this
-    #     :param num_qbits: int, num qbits for state psi
-    circ_depth = 8
-    num_qbits = 3
 
-    psi_vect = [complex(v) for v in line.split(',')]
-    psi = qiskit.quantum_info.Statevector(psi_vect)
+    index, line = job
+    line = line.rstrip('\n') + '\n'
+    psi_vect = np.array([complex(v) for v in line.split(',')])
 
-    initial_theta = initialize_theta(circ_depth=circ_depth, num_qbits=num_qbits)
-    results, optimizer_data = copt.optimize_theta_scp(initial_theta, psi)  # Learn theta using VQCs
-    optimized_theta = optimizer_data[-1]  # Final result
+    inferred_qbits = int(np.log2(len(psi_vect)))
+    if num_qbits is not None and num_qbits != inferred_qbits:
+        raise ValueError(f'state {index} has {len(psi_vect)} amplitudes, expected {2**num_qbits}')
 
-    theta_str_lst = [str(i) for i in optimized_theta]
-    row = ",".join(theta_str_lst) + "\n"
+    thetas = []
+    for circ_depth in circ_depths:
+        initial_theta = initialize_theta(circ_depth=circ_depth, num_qbits=inferred_qbits)
+        with metrics.timer('qml_main.state'):
+            results, optimizer_data = copt.optimize_theta_scp(initial_theta, psi_vect, method=method, maxiter=maxiter,
+                                                              tol=tol)  # Learn theta using VQCs
+        thetas.append(np.reshape(results.x, (circ_depth, inferred_qbits)))  # Final result
+        metrics.log_run('state', index=index, circ_depth=circ_depth, num_qbits=inferred_qbits, nit=results.get('nit'),
+                        nfev=results.nfev, loss=results.fun)
 
-    return [line, row]
+    return [index, line, psi_vect, thetas]
 
 
 def main():
     # multi_processing_attempt("3Qbit_psi_1k.txt")
+    # multi_processing_attempt("3Qbit_psi_1k.txt", circ_depth=[2, 4, 6, 8, 10])  # depth sweep
     return
 
 
@@ -1,6 +1,13 @@
-from qiskit import *
+import functools
+import numpy as np
+import metrics
+import precision
 
+BACKENDS = ('numpy', 'qiskit', 'mps')  # simulation engines available to get_state / copt.get_fidelity
+DEFAULT_BACKEND = 'numpy'
 
+
+@metrics.timed('qpu.construct_circ')
 def construct_variational_circ(theta, debug=False):
     """
     Generate a parameterized variational quantum circuit
@@ -9,6 +16,8 @@ def construct_variational_circ(theta, debug=False):
     :return: qiskit.QuantumCircuit object, the variational circuit
     """
 
+    import qiskit  # heavy, only imported on the qiskit backend path
+
     circ_depth, num_qbits = theta.shape
     var_circ = qiskit.QuantumCircuit(num_qbits)
     lst_qbits = range(num_qbits)
@@ -38,6 +47,7 @@ def construct_variational_circ(theta, debug=False):
     return var_circ
 
 
+@metrics.timed('qpu.simulate_circ')
 def simulate_circ(circ):
     """
     Generates our estimate state |phi> via simulation
@@ -45,6 +55,9 @@ def simulate_circ(circ):
     :return: qiskit.Statevector object, represents our estimated quantum state |phi>
     """
 
+    import qiskit
+    from qiskit import Aer, execute
+
     backend = Aer.get_backend('statevector_simulator')   # get simulator
     job = execute(circ, backend)
     result = job.result()
@@ -54,6 +67,190 @@ def simulate_circ(circ):
     return circ_statevect
 
 
+def layer_cx_pairs(layer, num_qbits):
+    """
+    Determine the (control, target) pairs of the cx gates applied in a given
+    layer of the variational circuit. Mirrors the placement used in
+    construct_variational_circ.
+
+    :param layer: int, index of the layer in the circuit
+    :param num_qbits: int, number of qbits
+    :return: list of tuples, (control, target) qbit indices
+    """
+
+    is_odd_step = (layer + 1) % 2
+    return [(qbit - is_odd_step - 1, qbit - is_odd_step) for qbit in range(2, num_qbits, 2)]
+
+
+def rx_matrix(angle):
+    """
+    Matrix of the rx rotation gate
+    :param angle: float or np.array, rotation angle(s)
+    :return: np.array of shape angle.shape + (2, 2)
+    """
+
+    c, s = np.cos(np.divide(angle, 2)), np.sin(np.divide(angle, 2))
+    gate = np.array([[c, -1j * s], [-1j * s, c]])
+    return np.moveaxis(gate, (0, 1), (-2, -1))
+
+
+def ry_matrix(angle):
+    """
+    Matrix of the ry rotation gate
+    :param angle: float or np.array, rotation angle(s)
+    :return: np.array of shape angle.shape + (2, 2)
+    """
+
+    c, s = np.cos(np.divide(angle, 2)), np.sin(np.divide(angle, 2))
+    gate = np.array([[c, -s], [s, c]], dtype=complex)
+    return np.moveaxis(gate, (0, 1), (-2, -1))
+
+
+def layer_gate(layer, circ_depth):
+    """
+    Returns the rotation gate used in a given layer, rx on even layers
+    (and the bonus last layer) and ry on odd layers.
+    :param layer: int, index of the layer in the circuit
+    :param circ_depth: int, number of layers in the circuit
+    :return: function, angle -> np.array of shape (2, 2)
+    """
+
+    is_odd_step = (layer + 1) % 2
+    if is_odd_step or layer == circ_depth - 1:
+        return rx_matrix
+    return ry_matrix
+
+
+def cx_permutation(layer, num_qbits):
+    """
+    Index permutation equivalent to all the cx gates of a layer. Applying the
+    cx gates to a statevector is the same as indexing it with this array
+    (qiskit ordering: qbit 0 is the least significant bit).
+
+    :param layer: int, index of the layer in the circuit
+    :param num_qbits: int, number of qbits
+    :return: np.array of ints or None if the layer has no cx gates
+    """
+
+    # the cx placement only depends on the parity of the layer, so there are two permutations per num_qbits
+    return _cx_permutation(layer % 2, num_qbits)
+
+
+@functools.lru_cache(maxsize=None)
+def _cx_permutation(parity, num_qbits):
+    pairs = layer_cx_pairs(parity, num_qbits)
+    if not pairs:
+        return None
+
+    index = np.arange(2**num_qbits)
+    perm = index
+    for control, target in pairs:
+        flip = np.where((index >> control) & 1, index ^ (1 << target), index)
+        perm = perm[flip]  # cx gates within a layer act on disjoint qbits so they commute
+
+    perm.setflags(write=False)
+    return perm
+
+
+def apply_gate(state, gate, qbit):
+    """
+    Apply a single qbit gate to a statevector (or a stack of statevectors)
+    using tensor reshapes
+    :param state: np.array, statevector(s) of shape (..., 2**num_qbits)
+    :param gate: np.array of shape (..., 2, 2), one gate per statevector
+    :param qbit: int, the qbit the gate acts on
+    :return: np.array, the new statevector(s)
+    """
+
+    tensor = np.reshape(state, state.shape[:-1] + (-1, 2, 2**qbit))
+    tensor = np.einsum('...ij,...ajb->...aib', gate, tensor)
+    return np.reshape(tensor, state.shape)
+
+
+@metrics.timed('qpu.simulate')
+def simulate_thetas(thetas, dtype=None):
+    """
+    Batched version of simulate_theta, simulates a whole stack of
+    parameterizations in one vectorized pass.
+    :param thetas: np.array of shape (B, circ_depth, num_qbits)
+    :param dtype: complex dtype of the statevectors, precision.complex_dtype() if None
+    :return: np.array of shape (B, 2**num_qbits), the statevectors |phi>
+    """
+
+    dtype = dtype or precision.complex_dtype()
+    thetas = np.asarray(thetas)
+    batch_size, circ_depth, num_qbits = thetas.shape
+    metrics.count('qpu.simulations', batch_size)
+    states = np.zeros((batch_size, 2**num_qbits), dtype=dtype)
+    states[:, 0] = 1
+
+    for layer in range(circ_depth):
+        gate = layer_gate(layer, circ_depth)
+        for qbit in range(num_qbits):
+            states = apply_gate(states, gate(thetas[:, layer, qbit]).astype(dtype, copy=False), qbit)
+
+        if layer != circ_depth - 1:  # bonus layer at the end has no cx
+            perm = cx_permutation(layer, num_qbits)
+            if perm is not None:
+                states = states[:, perm]
+
+    return states
+
+
+def simulate_theta(theta, dtype=None):
+    """
+    Generates our estimate state |phi> by applying the variational circuit
+    straight to a numpy statevector, without building a qiskit circuit.
+    :param theta: np.array, describes the parameters in the variational circuit
+    :param dtype: complex dtype of the statevector, precision.complex_dtype() if None
+    :return: np.array, the statevector |phi> (qiskit qbit ordering)
+    """
+
+    return simulate_thetas(np.asarray(theta)[np.newaxis], dtype)[0]
+
+
+@metrics.timed('qpu.overlap_gradient')
+def overlap_gradient(theta, bra, phi=None):
+    """
+    Compute the gradient of the overlap <bra|phi(theta)> wrt every theta parameter
+    with the adjoint method: one forward sweep to get |phi> and one backward
+    sweep undoing the gates, instead of a simulation per parameter.
+
+    :param theta: np.array, describes the parameters in the variational circuit
+    :param bra: qiskit.Statevector or np.array, the state <bra| is built from
+    :param phi: np.array, optional, simulate_theta(theta) if already computed
+    :return: np.array of complex, same shape as theta, d<bra|phi>/dtheta
+    """
+
+    circ_depth, num_qbits = theta.shape
+    if phi is None:
+        phi = simulate_theta(theta)
+
+    # phi and lam are stacked so undoing a gate is a single matmul on both. Once
+    # both are moved back past R(t), <lam|dR(t)/dt|phi> = <lam'|R(t)^-1 R(t + pi) / 2|phi'>
+    # = <lam'|R(pi) / 2|phi'>, the derivative matrix does not depend on the angle.
+    dtype = phi.dtype  # both sweeps run in the precision phi was simulated in
+    states = np.stack([phi, np.asarray(getattr(bra, 'data', bra), dtype=dtype)])
+    grad = np.zeros(theta.shape, dtype=complex)
+
+    for layer in reversed(range(circ_depth)):
+        if layer != circ_depth - 1:
+            perm = cx_permutation(layer, num_qbits)
+            if perm is not None:  # the cx permutation is its own inverse
+                states = states[:, perm]
+
+        gate = layer_gate(layer, circ_depth)
+        inverses = np.conj(np.swapaxes(gate(theta[layer]), -1, -2)).astype(dtype, copy=False)
+        derivative = (0.5 * gate(np.pi)).astype(dtype, copy=False)
+        for qbit in reversed(range(num_qbits)):
+            tensor = np.matmul(inverses[qbit], np.reshape(states, (2, -1, 2, 2**qbit)))
+            grad[layer][qbit] = np.vdot(tensor[1], np.matmul(derivative, tensor[0]))
+            states = np.reshape(tensor, states.shape)
+
+    return grad
+
+
+@metrics.timed('qpu.fidelity')
 def compute_fidelity(psi, phi):
     """
     Compute the fidelity (a measure of similarity) between the two states
@@ -62,20 +259,67 @@ def compute_fidelity(psi, phi):
     :return: float, fidelity
     """
 
+    import qiskit.quantum_info
+
     fidelity = qiskit.quantum_info.state_fidelity(psi, phi)
     return fidelity
 
 
-def get_state(theta):
+@metrics.timed('qpu.fidelity')
+def compute_overlap_fidelity(psi, phi):
+    """
+    Compute the fidelity |<psi|phi>|^2 between two pure states with numpy
+    :param psi: qiskit.Statevector or np.array, our target state |psi>
+    :param phi: qiskit.Statevector or np.array, our estimated state |phi>
+    :return: float, fidelity
+    """
+
+    psi = np.asarray(getattr(psi, 'data', psi))
+    phi = np.asarray(getattr(phi, 'data', phi))
+    return float(np.abs(np.vdot(psi, phi)) ** 2)
+
+
+def get_state(theta, backend=DEFAULT_BACKEND, max_bond=None):
     """
     Use the parameter matrix (theta) to recreate state
     :param theta: np.array, describes the parameters in the variational circuit
-    :return: qiskit.quantum_info.Statevector
+    :param backend: str, simulation engine, one of BACKENDS
+    :param max_bond: int, optional, maximum bond dimension of the 'mps' backend (mps.DEFAULT_MAX_BOND if None)
+    :return: qiskit.quantum_info.Statevector, or mps.MPS for the 'mps' backend
     """
 
-    circ = construct_variational_circ(theta)
-    state = simulate_circ(circ)
-    return state
+    if backend == 'mps':  # never builds the dense statevector
+        import mps
+        return mps.simulate_theta(theta, max_bond=max_bond or mps.DEFAULT_MAX_BOND)
+
+    import qiskit.quantum_info
+
+    if backend == 'numpy':
+        return qiskit.quantum_info.Statevector(simulate_theta(theta))
+    elif backend == 'qiskit':
+        circ = construct_variational_circ(theta)
+        return simulate_circ(circ)
+
+    raise ValueError(f'unknown backend {backend!r}, expected one of {BACKENDS}')
+
+
+def warm_up(num_qbits=range(1, 7), qiskit=True):
+    """
+    Preload what the first simulation would otherwise load lazily: the qiskit
+    modules (several seconds to import) and the cached cx permutations. Call it
+    in a parent process before forking workers, so every child starts warm.
+
+    :param num_qbits: iterable of ints, numbers of qbits to build the cx permutations for
+    :param qiskit: bool, also import qiskit (not needed by the numpy backend)
+    :return: None
+    """
+
+    if qiskit:
+        import qiskit.quantum_info
+
+    for qbits in num_qbits:
+        cx_permutation(0, qbits)
+        cx_permutation(1, qbits)
 
 
 def main():
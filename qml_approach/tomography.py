@@ -0,0 +1,121 @@
+# shot based tomography: fit theta to measurement counts taken in several bases
+import functools
+import numpy as np
+import qpu
+
+BASIS_GATES = {  # per qbit change of basis, same convention as data_gen.change_basis
+    'z': np.eye(2, dtype=complex),
+    'x': qpu.ry_matrix(-np.pi / 2),
+    'y': qpu.rx_matrix(np.pi / 2),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def basis_unitaries(bases, num_qbits):
+    """
+    Build (once, the result is cached) the change of basis unitaries for a tuple of
+    measurement bases. A basis is either a single label ('x', 'y' or 'z') applied
+    to every qbit, or a string with one label per qbit where the rightmost
+    character is qbit 0 (qiskit ordering), e.g. 'xzy'.
+
+    :param bases: tuple of str, the measurement bases
+    :param num_qbits: int, number of qbits
+    :return: np.array of shape (len(bases), 2**num_qbits, 2**num_qbits)
+    """
+
+    unitaries = []
+    for basis in bases:
+        labels = basis * num_qbits if len(basis) == 1 else basis
+        if len(labels) != num_qbits:
+            raise ValueError(f'basis {basis!r} does not match {num_qbits} qbits')
+
+        unitary = np.ones((1, 1), dtype=complex)
+        for label in labels:  # leftmost label is the highest qbit
+            unitary = np.kron(unitary, BASIS_GATES[label])
+        unitaries.append(unitary)
+
+    unitaries = np.array(unitaries)
+    unitaries.setflags(write=False)
+    return unitaries
+
+
+def get_frequencies(counts):
+    """
+    Normalize measurement counts into frequencies, one row per basis
+    :param counts: np.array of shape (num_bases, 2**num_qbits), counts of each outcome
+    :return: np.array of same shape, frequencies
+    """
+
+    counts = np.asarray(counts, dtype=float)
+    return counts / np.sum(counts, axis=1, keepdims=True)
+
+
+def compute_shot_loss(theta, unitaries, frequencies, eps=1e-12):
+    """
+    Compute the empirical loss between the state phi reconstructed from theta and
+    the measured frequencies, evaluated for all bases in one batch. The loss is
+    the KL divergence between measured and predicted outcome distributions,
+    averaged over the bases (0 for a perfect fit). Also returns its gradient
+    wrt theta, computed with the adjoint method.
+
+    :param theta: np.array, the parameterization matrix (circ_depth, num_qbits)
+    :param unitaries: np.array of shape (num_bases, dim, dim), see basis_unitaries
+    :param frequencies: np.array of shape (num_bases, dim), see get_frequencies
+    :param eps: float, floor on predicted probabilities to keep the log finite
+    :return: float loss and np.array of same shape as theta, the gradient
+    """
+
+    num_bases = len(unitaries)
+    phi = qpu.simulate_theta(theta, np.complex128)  # fits stay in double precision, see copt.FIT_DTYPE
+    amplitudes = unitaries @ phi  # (num_bases, dim), phi expressed in every basis
+    probabilities = np.maximum(np.abs(amplitudes) ** 2, eps)
+
+    observed = frequencies > 0
+    loss = np.sum(frequencies[observed] * np.log(frequencies[observed] / probabilities[observed])) / num_bases
+
+    # dL/dphi* pulled back through every change of basis, then through the circuit
+    weights = -(frequencies / probabilities) * amplitudes / num_bases
+    costate = np.einsum('bij,bi->j', np.conj(unitaries), weights)
+    dl_dtheta = 2 * np.real(qpu.overlap_gradient(theta, costate, phi=phi))
+
+    return loss, dl_dtheta
+
+
+def optimize_theta_shots(theta, counts, bases, method='BFGS', maxiter=100, tol=None):
+    """
+    Shot based tomography. Determines the parameterization (theta) of the variational
+    circuit whose state best reproduces the measurement counts taken in several bases,
+    without knowing the target state.
+
+    :param theta: np.array, initial parameterization matrix (circ_depth, num_qbits)
+    :param counts: np.array of shape (num_bases, 2**num_qbits), outcome counts in each basis
+    :param bases: list of str, the basis each row of counts was measured in (see basis_unitaries)
+    :param method: str, gradient based scipy.optimize.minimize method
+    :param maxiter: int, maximum number of optimizer iterations
+    :param tol: float, optional, tolerance for termination
+    :return: results from optimizer and list (optimizer data), theta after each iteration
+    """
+
+    import scipy.optimize as opt  # imported on the first fit
+
+    circ_depth, num_qbits = theta.shape
+    unitaries = basis_unitaries(tuple(bases), num_qbits)
+    frequencies = get_frequencies(counts)
+    optimizer_data = []
+
+    def loss_and_gradient(theta_vector):
+        loss, dl_dtheta = compute_shot_loss(np.reshape(theta_vector, theta.shape), unitaries, frequencies)
+        return loss, np.ravel(dl_dtheta)
+
+    results = opt.minimize(loss_and_gradient, np.ravel(theta), method=method, jac=True,
+                           callback=optimizer_data.append, tol=tol, options={'maxiter': maxiter})
+
+    return results, optimizer_data
+
+
+def main():
+    return
+
+
+if __name__ == "__main__":
+    main()
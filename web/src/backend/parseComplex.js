@@ -14,4 +14,62 @@ function parseComplex(reply) {
   return reply;
 }
 
+async function decodeBytes(base64, compression) {
+  // base64 (optionally zlib compressed) -> bytes
+  const bytes = Uint8Array.from(atob(base64), (c) => c.charCodeAt(0));
+  if (!compression) return bytes;
+
+  const stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream('deflate'));
+  return new Uint8Array(await new Response(stream).arrayBuffer());
+}
+
+function toFloat32(bytes) {
+  // Copy into an aligned little endian float32 array
+  const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+  const values = new Float32Array(bytes.byteLength / 4);
+  for (let i = 0; i < values.length; ++i) {
+    values[i] = view.getFloat32(i * 4, true);
+  }
+  return values;
+}
+
+function toState(values, offset, dim) {
+  // (real, imag) pairs -> { basis label: Complex }, same layout as parseComplex
+  const numQbits = Math.log2(dim);
+  const state = {};
+  for (let i = 0; i < dim; ++i) {
+    const label = i.toString(2).padStart(numQbits, '0');
+    state[label] = Complex.from(values[offset + 2 * i], values[offset + 2 * i + 1]);
+  }
+  return state;
+}
+
+export function parseCompactState(base64) {
+  // A single base64 float32 state of shape (2**n, 2), as streamed by /qml/jobs
+  const values = toFloat32(Uint8Array.from(atob(base64), (c) => c.charCodeAt(0)));
+  return toState(values, 0, values.length / 2);
+}
+
+export async function parseCompact(reply) {
+  // Decode a reply sent with format 'compact' (see backend/qml.compact_output)
+  const [iterations, dim] = reply.shape;
+  const values = toFloat32(await decodeBytes(reply.phis, reply.compression));
+
+  if (reply.delta) {
+    // Iterations are stored as differences from the previous one
+    const running = new Float64Array(dim * 2);
+    for (let i = 0; i < values.length; ++i) {
+      running[i % running.length] += values[i];
+      values[i] = running[i % running.length];
+    }
+  }
+
+  const phis = [];
+  for (let i = 0; i < iterations; ++i) {
+    phis.push(toState(values, i * dim * 2, dim));
+  }
+
+  return { ...reply, phis };
+}
+
 export default parseComplex;
@@ -1,7 +1,7 @@
 import { LitElement, html } from 'lit';
 
 import post from '../backend/post.js';
-import parseComplex from '../backend/parseComplex.js';
+import parseComplex, { parseCompactState } from '../backend/parseComplex.js';
 import { draw, CANVAS_SIZE } from '../lib/QMLCanvas.js';
 
 export class QMLDemo extends LitElement {
@@ -25,6 +25,8 @@ export class QMLDemo extends LitElement {
     this.numQbits = 5;
     this.visual = 'Line';
     this._resizeObserver = null;
+    this._source = null;
+    this._jobId = null;
   }
 
   createRenderRoot() {
@@ -52,6 +54,10 @@ export class QMLDemo extends LitElement {
     if (this._resizeObserver) {
       this._resizeObserver.disconnect();
     }
+    if (this._source) {
+      this._handleCancel();
+      this._source.close();
+    }
   }
 
   updated(changedProperties) {
@@ -98,30 +104,73 @@ export class QMLDemo extends LitElement {
 
     this.error = false;
     this.loading = true;
+    this.cache = null;
+    this.index = 0;
 
     try {
-      const response = await post('qml', {
+      // Submit the fit, then draw each iteration as the backend streams it
+      const response = await post('qml/jobs', {
         circ_depth: this.circDepth,
-        num_qbits: this.numQbits
+        num_qbits: this.numQbits,
+        format: 'compact'
       });
 
-      const reply = await response.json();
-
-      if (reply === 'Error') {
-        throw new Error('QML computation failed');
+      if (!response.ok) {
+        throw new Error('QML job submission failed');
       }
 
-      const data = parseComplex(reply);
-      this.cache = data;
-      this.index = 0;
+      const { job_id } = await response.json();
+      this._jobId = job_id;
+      this._listen(job_id);
     } catch (err) {
       console.error('QML Demo error:', err);
       this.error = true;
-    } finally {
       this.loading = false;
     }
   }
 
+  _listen(jobId) {
+    const data = { phis: [], loss_series: [], fidelity_series: [], maxMag: 1 };
+    const source = new EventSource(`/qml/jobs/${jobId}/stream`);
+    this._source = source;
+
+    const follow = () => this.index === Math.max(0, data.phis.length - 2);
+    const finish = (error) => {
+      source.close();
+      this._source = null;
+      this._jobId = null;
+      this.error = error;
+      this.loading = false;
+    };
+
+    source.addEventListener('iteration', (e) => {
+      const frame = JSON.parse(e.data);
+      const phi = typeof frame.phi === 'string'
+        ? parseCompactState(frame.phi)
+        : parseComplex({ phis: [frame.phi] }).phis[0];
+
+      data.phis.push(phi);
+      data.loss_series.push(frame.loss);
+      data.fidelity_series.push(frame.fidelity);
+      data.maxMag = frame.maxMag;
+
+      this.cache = { ...data };
+      if (follow()) this.index = data.phis.length - 1;
+    });
+    source.addEventListener('done', () => finish(false));
+    source.addEventListener('cancelled', () => finish(false));
+    source.addEventListener('error', (e) => {
+      console.error('QML Demo error:', e.data || 'stream closed');
+      finish(true);
+    });
+  }
+
+  _handleCancel() {
+    if (this._jobId) {
+      fetch(`/qml/jobs/${this._jobId}`, { method: 'DELETE' });
+    }
+  }
+
   _getPhiCount() {
     return this.cache ? Object.keys(this.cache.phis).length : 0;
   }
@@ -129,7 +178,7 @@ export class QMLDemo extends LitElement {
   render() {
     return html`
       <h2>Quantum Machine Learning Demo</h2>
-      <p>Adjust circuit parameters and click START to compute. Warning: This computation takes several minutes.</p>
+      <p>Adjust circuit parameters and click START to compute. Iterations are drawn as soon as they are computed.</p>
 
       <canvas></canvas>
 
@@ -169,6 +218,12 @@ export class QMLDemo extends LitElement {
             ${this.loading ? 'Computing...' : 'START'}
           </sl-button>
         </div>
+
+        ${this.loading ? html`
+          <div style="flex: 0; min-width: 120px;">
+            <sl-button size="large" @click="${this._handleCancel}">CANCEL</sl-button>
+          </div>
+        ` : ''}
       </div>
 
       ${this.cache ? html`
@@ -196,7 +251,7 @@ export class QMLDemo extends LitElement {
         </div>
       ` : ''}
 
-      ${this.loading ? html`<p><em>Computing... This may take several minutes. Please wait.</em></p>` : ''}
+      ${this.loading ? html`<p><em>Computing... ${this._getPhiCount()} iterations so far.</em></p>` : ''}
       ${this.error ? html`<p style="color: var(--sl-color-danger-600);"><strong>Error. Try different parameters or check backend connection.</strong></p>` : ''}
 
       <p>A quantum state can be represented as 2^n complex coefficients where the absolute value is between 0 and 1. Where n is the number of qubits.</p>
@@ -1,8 +1,18 @@
+import itertools
 import numpy as np
+import os
+import sys
 import tensorflow as tf
 from tensorflow.keras.optimizers import SGD
 from tensorflow.keras.models import load_model
 
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.join(root, 'data_gen'))
+sys.path.insert(1, os.path.join(root, 'qml_approach'))
+
+import data_io
+import precision
+
 
 def split_data(x_data, y_data, ptrain=0.70, pvalidate=0.20, ptest=0.10):
     """
@@ -34,34 +44,128 @@ def split_data(x_data, y_data, ptrain=0.70, pvalidate=0.20, ptest=0.10):
         return (xtrain, ytrain), (xvalidate, yvalidate), (xtest, ytest)
 
 
-def open_files(psi_file, theta_file):
+def split_indices(num_states, ptrain=0.70, pvalidate=0.20, ptest=0.10, seed=None):
+    """
+    Shuffle the row indices of a data set and split them into training,
+    validation and testing indices of the specified size. Used to split data
+    sets which are streamed from disk instead of loaded into memory.
+
+    :param num_states: int, number of rows in the data set
+    :param ptrain: float, precent of total data_set to be allocated for training
+    :param pvalidate: float, precent of total data_set to be allocated for validation
+    :param ptest: float, precent of total data_set to be allocated for testing
+    :param seed: int, optional, seed for the shuffle
+    :return: 3 np.arrays, train, validate and test indices
+    """
+
+    assert np.isclose(ptrain + pvalidate + ptest, 1.0), 'ptrain, pvalidate, ptest must add up to 100%'
+
+    indices = np.random.default_rng(seed).permutation(num_states)
+    b1 = int(np.floor(num_states * ptrain))
+    b2 = int(np.ceil(num_states * (1-ptest)))
+    return indices[:b1], indices[b1: b2], indices[b2:]
+
+
+def make_dataset(path, indices=None, batch_size=2500, shuffle=True, shuffle_buffer=100_000, seed=None):
+    """
+    Stream (theta, psi) batches from a binary data set (see data_gen/data_io.py) as
+    a tf.data pipeline. Only the row indices are shuffled in memory, each batch is
+    gathered from the memory-mapped files on the fly and prefetched, so the data set
+    can be larger than RAM.
+
+    :param path: str, directory of the binary data set
+    :param indices: np.array, optional, rows to use (e.g. from split_indices), all rows if None
+    :param batch_size: int, number of rows per batch
+    :param shuffle: bool, reshuffle the rows every epoch
+    :param shuffle_buffer: int, size of the shuffle buffer (in row indices)
+    :param seed: int, optional, seed for the shuffle
+    :return: tf.data.Dataset of (theta batch, psi batch), psi with (real, imag) interleaved
+    """
+
+    psi_raw, theta_raw = open_dataset(path)
+    indices = np.arange(len(psi_raw)) if indices is None else np.asarray(indices)
+
+    def gather(batch_indices):
+        batch_indices = np.sort(batch_indices)  # sorted reads are faster on the memory map
+        # no second copy when the data set is already stored in single precision
+        return (theta_raw[batch_indices].astype(np.float32, copy=False),
+                psi_raw[batch_indices].astype(np.float32, copy=False))
+
+    def load_batch(batch_indices):
+        theta_batch, psi_batch = tf.numpy_function(gather, [batch_indices], (tf.float32, tf.float32))
+        theta_batch.set_shape((None, theta_raw.shape[1]))
+        psi_batch.set_shape((None, psi_raw.shape[1]))
+        return theta_batch, psi_batch
+
+    dataset = tf.data.Dataset.from_tensor_slices(indices)
+    if shuffle:
+        dataset = dataset.shuffle(min(len(indices), shuffle_buffer), seed=seed, reshuffle_each_iteration=True)
+
+    dataset = dataset.batch(batch_size).map(load_batch, num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def open_files(psi_file, theta_file, skiprows=0, max_rows=None, dtype=None):
     """
     function to open the txt files and extract the meta data from
     the files containing the raw data for quantum states (psi) and the parameterizations (theta) .
+    The files are parsed in bulk by numpy and the number of columns is inferred from the data.
     :param psi_file: str, path to the txt file containing quantum state data
     :param theta_file: str, path to the txt file containing the parameterization data
+    :param skiprows: int, number of rows to skip at the start of the files
+    :param max_rows: int, optional, read at most this many rows (all rows if None)
+    :param dtype: complex dtype of psi, precision.complex_dtype() if None (theta gets the matching float dtype)
     :return: 2 np.arrays, containing the raw data: psi_data and theta_data
     """
 
-    with open(psi_file, 'r') as psi_data:
-        lines_psi = psi_data.readlines()
-        psi_raw = np.zeros((len(lines_psi), 8*2))
+    dtype = np.dtype(dtype or precision.complex_dtype())
+    psi = np.loadtxt(psi_file, dtype=dtype, delimiter=',', skiprows=skiprows, max_rows=max_rows, ndmin=2)
+    theta_raw = np.loadtxt(theta_file, dtype=np.finfo(dtype).dtype, delimiter=',', skiprows=skiprows,
+                           max_rows=max_rows, ndmin=2)
+
+    psi_raw = psi.view(psi.real.dtype)  # complex -> (real, imag) pairs
+    return psi_raw, theta_raw
+
+
+def iter_files(psi_file, theta_file, chunk_size=10_000, dtype=None):
+    """
+    Same as open_files, but processes the txt files in chunks so corpora larger
+    than memory can be streamed.
+    :param psi_file: str, path to the txt file containing quantum state data
+    :param theta_file: str, path to the txt file containing the parameterization data
+    :param chunk_size: int, number of rows per chunk
+    :param dtype: complex dtype of psi, precision.complex_dtype() if None (theta gets the matching float dtype)
+    :return: generator of (psi_data, theta_data) np.array chunks
+    """
+
+    dtype = np.dtype(dtype or precision.complex_dtype())
+
+    with open(psi_file, 'r') as psi_data, open(theta_file, 'r') as theta_data:
+        while True:
+            lines_psi = list(itertools.islice(psi_data, chunk_size))
+            lines_theta = list(itertools.islice(theta_data, chunk_size))
+            if not lines_psi:
+                return
 
-        for i, line in enumerate(lines_psi):
-            val = [complex(j) for j in line.split(',')]
-            vect = []
-            for num in val:
-                vect.append(np.real(num))
-                vect.append(np.imag(num))
+            psi = np.loadtxt(lines_psi, dtype=dtype, delimiter=',', ndmin=2)
+            theta_raw = np.loadtxt(lines_theta, dtype=np.finfo(dtype).dtype, delimiter=',', ndmin=2)
+            yield psi.view(psi.real.dtype), theta_raw
 
-            psi_raw[i] = vect
 
-    with open(theta_file, 'r') as theta_data:
-        lines_theta = theta_data.readlines()
-        theta_raw = np.zeros((len(lines_theta), 24))
-        for i, line in enumerate(lines_theta):
-            theta_raw[i] = [float(j) for j in line.split(',')]
+def open_dataset(path):
+    """
+    Open a binary data set (see data_gen/data_io.py) and return it in the same layout
+    as open_files. The arrays are memory-mapped views of the files on disk, nothing
+    is parsed or copied into RAM up front. The arrays keep the precision the data
+    set was stored in (float64 or float32).
 
+    :param path: str, directory of the binary data set
+    :return: 2 np.arrays, psi_data (real, imag interleaved) and theta_data (flattened)
+    """
+
+    header, psi, theta = data_io.open_dataset(path)
+    psi_raw = psi.view(psi.real.dtype)  # complex -> (real, imag) pairs without a copy
+    theta_raw = np.reshape(theta, (len(theta), -1))
     return psi_raw, theta_raw
 
 
@@ -79,35 +183,62 @@ def my_loss_fn(y_true, y_pred):
     return tf.reduce_mean(squared_difference, axis=-1)
 
 
-def train_model(xtrain, ytrain, input_len, modelname):
+def complex_fidelity(y_true, y_pred):
+    """
+    Fidelity between the true and predicted quantum states, vectorized over the
+    batch. The states have their complex coefficients split into (real, imag)
+    pairs. Usable as a Keras metric.
+
+    :param y_true: tensor or np.array of shape (N, 2 * 2**num_qbits), "true" states
+    :param y_pred: tensor or np.array of shape (N, 2 * 2**num_qbits), "predicted" states
+    :return: tensor of shape (N,), fidelity of each pair of states
+    """
+
+    y_true = tf.cast(y_true, tf.float32)
+    y_pred = tf.cast(y_pred, tf.float32)
+    b_real, b_imag = y_true[..., 0::2], y_true[..., 1::2]
+    a_real, a_imag = y_pred[..., 0::2], y_pred[..., 1::2]
+
+    term1 = tf.reduce_sum(a_real * b_real + a_imag * b_imag, axis=-1)
+    term2 = tf.reduce_sum(a_real * b_imag - a_imag * b_real, axis=-1)
+    return tf.square(term1) + tf.square(term2)
+
+
+def train_model(xtrain, ytrain, input_len, modelname, output_len=16, hidden_layers=(50, 50, 40, 40, 25, 16),
+                epochs=2500, batch_size=2500, learning_rate=0.075, validation_data=None):
     """
     Training a simple feed forward NN model to learn the
     mapping between variational circuit parameterizations and
     the associated quantum states
 
-    :param xtrain: parameterization data set for training
-    :param ytrain: associated quantum state data set for training
+    :param xtrain: parameterization data set for training, or a tf.data.Dataset of (theta, psi) batches
+    :param ytrain: associated quantum state data set for training (None if xtrain is a tf.data.Dataset)
     :param input_len: int, number of components in the parameterization vector (len(xtrain[i]))
     :param modelname: str, name of the model
+    :param output_len: int, number of components in the quantum state vector (len(ytrain[i]))
+    :param hidden_layers: tuple of ints, number of units of each hidden relu layer
+    :param epochs: int, number of training epochs
+    :param batch_size: int, batch size (ignored for a tf.data.Dataset, which is already batched)
+    :param learning_rate: float, learning rate of the SGD optimizer
+    :param validation_data: optional, validation data passed on to model.fit
     :return: None
     """
 
     # Train model
-    model = tf.keras.Sequential([
-        tf.keras.layers.Dense(50, activation='relu', input_shape=(None, input_len)),
-        tf.keras.layers.Dense(50, activation='relu'),
-        tf.keras.layers.Dense(40, activation='relu'),
-        tf.keras.layers.Dense(40, activation='relu'),
-        tf.keras.layers.Dense(25, activation='relu'),
-        tf.keras.layers.Dense(16, activation='relu'),
-        tf.keras.layers.Dense(16, activation='softsign')
-    ])
+    model = tf.keras.Sequential(
+        [tf.keras.layers.Dense(hidden_layers[0], activation='relu', input_shape=(None, input_len))] +
+        [tf.keras.layers.Dense(units, activation='relu') for units in hidden_layers[1:]] +
+        [tf.keras.layers.Dense(output_len, activation='softsign')]
+    )
     # model.summary()
 
-    sgd = SGD(lr=0.075)
+    sgd = SGD(learning_rate=learning_rate)
 
-    model.compile(optimizer=sgd, loss=my_loss_fn)
-    model.fit(epochs=2500, batch_size=2500, x=xtrain, y=ytrain)
+    model.compile(optimizer=sgd, loss=my_loss_fn, metrics=[complex_fidelity])
+    if isinstance(xtrain, tf.data.Dataset):
+        model.fit(xtrain, epochs=epochs, validation_data=validation_data)
+    else:
+        model.fit(epochs=epochs, batch_size=batch_size, x=xtrain, y=ytrain, validation_data=validation_data)
 
     # Save the model for future use
     model.save(f'{modelname}.h5')  # creates a HDF5 file
@@ -118,39 +249,46 @@ def main():
     # Load data
     psi_raw, theta_raw = open_files("./data/3Qbit_psi_1k_newPsi_dif.txt", "./data/3Qbit_psi_1k_newTheta_dif.txt")
     # psi_raw, theta_raw = open_files("./data/3Qbit_complex_psi_1k_newPsi.txt", "./data/3Qbit_complex_psi_1k_newTheta.txt")
+    # psi_raw, theta_raw = open_dataset("./data/3Qbit_psi_1k_dif.qst")  # binary data set, see data_gen/data_io.py
 
     # Create the different datasets
     (xTrain, yTrain), (xValidate, yValidate), (xTest, yTest) = split_data(theta_raw, psi_raw)
 
     modelname = "./model/QML_Model_1k_dif"
     train_model(xTrain, yTrain, theta_raw.shape[1], modelname)  # train model
-    model = load_model(f'{modelname}.h5', custom_objects={'my_loss_fn': my_loss_fn})
+    model = load_model(f'{modelname}.h5', custom_objects={'my_loss_fn': my_loss_fn,
+                                                          'complex_fidelity': complex_fidelity})
     model.evaluate(x=xValidate, y=yValidate)
 
     pred = model.predict(xTest)
+    x = np.round(np.abs(pred - yTest), 4)
+    fidelity = complex_fidelity(yTest, pred).numpy()
+
+    # Take the average and print results
+    print("Average error in test dataset for all 8 complex coefficients (split into (real, im)):")
+    print(np.mean(x, axis=0))
+    print("Average fidelity over all the training set: ", np.mean(fidelity, axis=0))
+    return
 
-    x = []
-    for i, j in zip(pred, yTest):
-        x.append([round(np.abs(a-b), 4) for a, b in zip(i, j)])
 
-    complex_fidelity = []
-    for tempX, tempY in zip(pred, yTest):
-        a = tempX
-        b = tempY
+def main_streaming(path="./data/3Qbit_psi_1k_dif.qst", modelname="./model/QML_Model_1k_dif", epochs=2500,
+                   batch_size=2500, learning_rate=0.075):
+    """
+    Same as main, but streams the training data from a binary data set
+    (see data_gen/data_io.py) so it does not have to fit in memory.
+    """
 
-        temp_term1, temp_term2 = 0, 0
-        while len(a) > 0:
-            temp_term1 += (a[0] * b[0]) + (a[1] * b[1])
-            temp_term2 += (a[0] * b[1]) - (a[1] * b[0])
-            a = a[2:]
-            b = b[2:]
+    psi_raw, theta_raw = open_dataset(path)
+    train, validate, test = split_indices(len(psi_raw), seed=1)
 
-        complex_fidelity.append(pow(temp_term1, 2) + pow(temp_term2, 2))
+    train_model(make_dataset(path, train, batch_size=batch_size, seed=1), None, theta_raw.shape[1], modelname,
+                output_len=psi_raw.shape[1], epochs=epochs, learning_rate=learning_rate,
+                validation_data=make_dataset(path, validate, batch_size=batch_size, shuffle=False))
+    model = load_model(f'{modelname}.h5', custom_objects={'my_loss_fn': my_loss_fn,
+                                                          'complex_fidelity': complex_fidelity})
 
-    # Take the average and print results
-    print("Average error in test dataset for all 8 complex coefficients (split into (real, im)):")
-    print(np.mean(np.array(x), axis=0))
-    print("Average fidelity over all the training set: ", np.mean(np.array(complex_fidelity), axis=0))
+    loss, fidelity = model.evaluate(make_dataset(path, test, batch_size=batch_size, shuffle=False))
+    print("Average fidelity over the test set: ", fidelity)
     return
 
 
@@ -0,0 +1,117 @@
+# NumPy-only inference for the saved Keras models, no TensorFlow needed at run time
+import json
+import numpy as np
+
+
+def _softmax(x):
+    exp = np.exp(x - np.max(x, axis=-1, keepdims=True))
+    return exp / np.sum(exp, axis=-1, keepdims=True)
+
+
+ACTIVATIONS = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0),
+    'softsign': lambda x: x / (1 + np.abs(x)),
+    'tanh': np.tanh,
+    'sigmoid': lambda x: 1 / (1 + np.exp(-x)),
+    'softmax': _softmax,
+}
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def export_weights(h5_file, npz_file):
+    """
+    Dump the dense layer weights and activations of a Keras model saved as HDF5
+    (see nn.train_model) into a compact .npz file. Only h5py is needed, the
+    model is read without loading TensorFlow.
+
+    :param h5_file: str, path to the saved Keras model (.h5)
+    :param npz_file: str, path of the .npz file to write
+    :return: None
+    """
+
+    import h5py  # optional dependency, only needed to export
+
+    with h5py.File(h5_file, 'r') as file:
+        config = json.loads(_decode(file.attrs['model_config']))
+        layers = config['config']['layers'] if isinstance(config['config'], dict) else config['config']
+        weights = file['model_weights']
+
+        arrays, activations = {}, []
+        for layer in layers:
+            if layer['class_name'] == 'InputLayer':
+                continue
+            if layer['class_name'] != 'Dense':
+                raise ValueError(f"unsupported layer {layer['class_name']}, only Dense layers can be exported")
+
+            group = weights[layer['config']['name']]
+            kernel_name, bias_name = (_decode(name) for name in group.attrs['weight_names'])
+            arrays[f'kernel_{len(activations)}'] = group[kernel_name][()]
+            arrays[f'bias_{len(activations)}'] = group[bias_name][()]
+            activations.append(layer['config']['activation'])
+
+    np.savez(npz_file, activations=np.array(activations), **arrays)
+    return
+
+
+class NumpyModel:
+    """
+    Batched forward pass of a feed forward network of dense layers, a drop in
+    replacement for model.predict of the Keras models trained in nn.py.
+    """
+
+    def __init__(self, kernels, biases, activations):
+        """
+        :param kernels: list of np.array, weight matrix of each layer (inputs, outputs)
+        :param biases: list of np.array, bias vector of each layer
+        :param activations: list of str, activation of each layer, keys of ACTIVATIONS
+        """
+
+        self.kernels = kernels
+        self.biases = biases
+        self.activations = [ACTIVATIONS[name] for name in activations]
+
+    @classmethod
+    def load(cls, npz_file):
+        """
+        :param npz_file: str, path of a file written by export_weights
+        :return: NumpyModel
+        """
+
+        with np.load(npz_file) as data:
+            activations = [str(name) for name in data['activations']]
+            kernels = [data[f'kernel_{i}'] for i in range(len(activations))]
+            biases = [data[f'bias_{i}'] for i in range(len(activations))]
+
+        return cls(kernels, biases, activations)
+
+    def predict(self, x, batch_size=65_536):
+        """
+        :param x: np.array of shape (N, inputs), e.g. flattened thetas
+        :param batch_size: int, number of rows evaluated at a time to bound memory use
+        :return: np.array of shape (N, outputs), e.g. psi with (real, imag) interleaved
+        """
+
+        x = np.asarray(x, dtype=self.kernels[0].dtype)
+        output = np.empty((len(x), len(self.biases[-1])), dtype=x.dtype)
+
+        for start in range(0, len(x), batch_size):
+            values = x[start:start + batch_size]
+            for kernel, bias, activation in zip(self.kernels, self.biases, self.activations):
+                values = activation(values @ kernel + bias)
+            output[start:start + batch_size] = values
+
+        return output
+
+
+def main():
+    # export_weights("./model/QML_Model_700.h5", "./model/QML_Model_700.npz")
+    # model = NumpyModel.load("./model/QML_Model_700.npz")
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+# Warm-start initialization for the VQC optimizer, maps a target state psi to an initial theta guess
+import numpy as np
+import os
+import sys
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.join(root, 'data_gen'))
+sys.path.insert(1, os.path.join(root, 'qml_approach'))
+
+import data_io
+import copt
+import qpu
+
+
+class WarmStart:
+    """
+    Initial theta guess for a target state psi. Holds a bank of (theta, state)
+    pairs, learned pairs from a data set or random thetas whose states are
+    simulated exactly, and picks the candidates whose states have the highest
+    fidelity with the target (a single matrix product over the whole bank).
+    A bank cannot cover the state space densely (a random bank of 10k thetas
+    reaches F ~ 0.75 on random 3 qbit targets), which barely helps the
+    optimizer, so the candidates are refined with a few steps of gradient
+    ascent on the fidelity before the best one is returned.
+
+    This shortens the optimization (about 31 instead of 36 iterations on random
+    3 qbit targets at depth 8) but the refinement costs about what it saves, so
+    it does not make fits faster overall. Use it for shorter trajectories (e.g.
+    the web demo), not for throughput, see compare_iterations.
+
+    Instances are callable (psi -> theta), so they can be passed as the warm_start
+    initialization strategy of copt.optimize_theta_scp.
+    """
+
+    def __init__(self, thetas, states, candidates=2, refine_steps=5, learning_rate=1.0):
+        """
+        :param thetas: np.array of shape (N, circ_depth, num_qbits), parameterizations in the bank
+        :param states: np.array of shape (N, 2**num_qbits), complex state produced by each theta
+        :param candidates: int, number of closest bank entries refined per target
+        :param refine_steps: int, gradient ascent steps on the candidates (0 returns the closest entry)
+        :param learning_rate: float, step size of the gradient ascent
+        """
+
+        self.thetas = np.asarray(thetas, dtype=float)
+        states = np.asarray(states, dtype=complex)
+        self.states = states / np.linalg.norm(states, axis=1, keepdims=True)
+        self.circ_depth, self.num_qbits = self.thetas.shape[1:]
+        self.candidates = candidates
+        self.refine_steps = refine_steps
+        self.learning_rate = learning_rate
+
+    @classmethod
+    def from_thetas(cls, thetas, **kwargs):
+        """
+        Build the bank from parameterizations only, their states are simulated (qpu.simulate_thetas)
+        :param thetas: np.array of shape (N, circ_depth, num_qbits), parameterizations in the bank
+        :param kwargs: candidates, refine_steps and learning_rate, see __init__
+        :return: WarmStart
+        """
+
+        thetas = np.asarray(thetas, dtype=float)
+        return cls(thetas, qpu.simulate_thetas(thetas, np.complex128), **kwargs)
+
+    @classmethod
+    def random(cls, circ_depth, num_qbits, size=10_000, seed=None, **kwargs):
+        """
+        Bank of uniformly random thetas, available for every circuit shape
+        :param circ_depth: int, number of layers in the variational circuit
+        :param num_qbits: int, number of qbits
+        :param size: int, number of thetas in the bank
+        :param seed: int, optional, seed for a reproducible bank
+        :param kwargs: candidates, refine_steps and learning_rate, see __init__
+        :return: WarmStart
+        """
+
+        rng = np.random.default_rng(seed)
+        return cls.from_thetas(rng.uniform(-np.pi, np.pi, (size, circ_depth, num_qbits)), **kwargs)
+
+    @classmethod
+    def from_files(cls, psi_file, theta_file, **kwargs):
+        """
+        Build the bank from the psi/theta txt files written by qml_main.multi_processing_attempt
+        :param psi_file: str, path to the txt file containing quantum state data
+        :param theta_file: str, path to the txt file containing the parameterization data
+        :param kwargs: candidates, refine_steps and learning_rate, see __init__
+        :return: WarmStart
+        """
+
+        states = np.loadtxt(psi_file, dtype=np.complex128, delimiter=',', ndmin=2)
+        thetas = np.loadtxt(theta_file, dtype=np.float64, delimiter=',', ndmin=2)
+        num_qbits = int(np.log2(states.shape[1]))
+        return cls(np.reshape(thetas, (len(thetas), -1, num_qbits)), states, **kwargs)
+
+    @classmethod
+    def from_dataset(cls, path, **kwargs):
+        """
+        Build the bank from a binary data set (see data_gen/data_io.py)
+        :param path: str, directory of the binary data set
+        :param kwargs: candidates, refine_steps and learning_rate, see __init__
+        :return: WarmStart
+        """
+
+        header, psi, theta = data_io.open_dataset(path)
+        return cls(theta, psi, **kwargs)
+
+    def refine(self, thetas, psi):
+        """
+        Gradient ascent on the fidelity of a stack of candidates, with the
+        adjoint gradient of every candidate (see copt.compute_fidelity_gradient).
+
+        :param thetas: np.array of shape (K, circ_depth, num_qbits), candidate parameterizations
+        :param psi: np.array, target state psi
+        :return: np.array of shape (circ_depth, num_qbits), the candidate with the highest fidelity
+        """
+
+        for _ in range(self.refine_steps):
+            gradient = [copt.compute_fidelity_gradient(theta, psi, method='adjoint')[1] for theta in thetas]
+            thetas = thetas + self.learning_rate * np.array(gradient)
+
+        fidelities = copt.get_fidelity_batch(thetas, psi, np.complex128)
+        return np.copy(thetas[np.argmax(fidelities)])
+
+    def predict(self, psi):
+        """
+        :param psi: qiskit.Statevector or np.array, target state psi
+        :return: np.array of shape (circ_depth, num_qbits), initial theta guess
+        """
+
+        psi = np.asarray(getattr(psi, 'data', psi))
+        if len(psi) != self.states.shape[1]:
+            raise ValueError(f'psi has {len(psi)} amplitudes, the bank holds {self.num_qbits} qbit states')
+
+        fidelities = np.abs(self.states @ np.conj(psi)) ** 2
+        if self.refine_steps == 0:
+            return np.copy(self.thetas[np.argmax(fidelities)])
+
+        candidates = min(self.candidates, len(fidelities))
+        closest = np.argpartition(fidelities, -candidates)[-candidates:]
+        return self.refine(self.thetas[closest], psi)
+
+    def __call__(self, psi):
+        return self.predict(psi)
+
+
+def compare_iterations(warm_start, psis, maxiter=100):
+    """
+    Report how many optimizer iterations the warm start saves compared to
+    starting from all zeros, over a list of target states. The wall time
+    includes the time spent in warm_start, so the refinement is not free.
+
+    :param warm_start: WarmStart, the initialization strategy
+    :param psis: list of qiskit.Statevector or np.array, target states
+    :param maxiter: int, maximum number of optimizer iterations
+    :return: dict, mean iterations, final fidelity and wall time for cold and warm starts, and iterations saved
+    """
+
+    report = {f'{name}_{value}': [] for name in ('cold', 'warm') for value in ('iterations', 'fidelity', 'time_s')}
+    zeros = np.zeros((warm_start.circ_depth, warm_start.num_qbits))
+
+    for psi in psis:
+        for name, strategy in (('cold', None), ('warm', warm_start)):
+            start = time.perf_counter()
+            results, optimizer_data = copt.optimize_theta_scp(zeros, psi, maxiter=maxiter, warm_start=strategy)
+            report[f'{name}_time_s'].append(time.perf_counter() - start)
+            report[f'{name}_iterations'].append(results.nit)
+            report[f'{name}_fidelity'].append(copt.get_fidelity(np.reshape(results.x, zeros.shape), psi))
+
+    report = {key: float(np.mean(value)) for key, value in report.items()}
+    report['iterations_saved'] = report['cold_iterations'] - report['warm_iterations']
+    return report
+
+
+def main():
+    # warm_start = WarmStart.random(circ_depth=8, num_qbits=3, seed=1)
+    # print(compare_iterations(warm_start, data_io.open_dataset("./data/3Qbit_psi_1k.qst")[1][:100]))
+    return
+
+
+if __name__ == "__main__":
+    main()